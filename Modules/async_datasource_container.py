@@ -0,0 +1,165 @@
+import asyncio
+import functools
+from concurrent.futures import Executor
+from typing import Any, Awaitable, Callable, Dict, Iterable, List
+from Modules.datasource_container import IDataSourceContainer
+from Modules.aws_datasource_container import AwsDataSourceContainer, AwsDataSourceSession
+from Modules.detector.freq2 import FrequencyDetector
+
+
+class AsyncAwsDataSourceContainer(IDataSourceContainer):
+    u"""
+        AwsDataSourceContainer の asyncio 版。
+        S3やDBにアクセスするメソッドはコルーチンになっており、ブロッキングな boto3 の呼び出しを
+        executor のスレッドで実行する。1つのイベントループ上で複数の対象のモデル読み込み・
+        学習データのダウンロード・スコアのアップロードを重ねて実行できる。
+
+        パスを組み立てるだけのメソッド(get_target_model_path など)は I/O を伴わないので同期のまま。
+
+        複数の対象を扱う場合は、S3クライアントをスレッド間で安全に共有するため
+        AwsDataSourceSession から作ったコンテナを渡すこと(from_session を参照)。
+
+        async with AsyncAwsDataSourceContainer(container) as async_container:
+            detectors = await async_container.load_freq_model_file(model_id, fsname, min_prob_dens)
+    """
+
+    def __init__(self, container: AwsDataSourceContainer, executor: Executor = None):
+        u"""
+            Parameters
+            ----------
+                container : AwsDataSourceContainer
+                    実際のデータアクセスを行うコンテナ
+                executor : concurrent.futures.Executor, optional
+                    ブロッキングな処理を実行する executor。指定しない場合はイベントループのデフォルト
+        """
+        self.container = container
+        self.executor = executor
+
+    @classmethod
+    def from_session(
+        cls,
+        session: AwsDataSourceSession,
+        target_name: str,
+        executor: Executor = None
+    ) -> "AsyncAwsDataSourceContainer":
+        return cls(session.container(target_name), executor=executor)
+
+    async def __run(self, func: Callable, *args, **kwargs) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(func, *args, **kwargs))
+
+    async def __aenter__(self):
+        await self.__run(self.container.__enter__)
+        return self
+
+    async def __aexit__(self, ex_type, ex_value, trace):
+        await self.__run(self.container.__exit__, ex_type, ex_value, trace)
+
+    async def save_model_data(self, status):
+        return await self.__run(self.container.save_model_data, status)
+
+    async def save_fpd_file(self, fpd_detector, model_id, fsname):
+        return await self.__run(self.container.save_fpd_file, fpd_detector, model_id, fsname)
+
+    async def load_fpd_file(self, model_id, fsname):
+        return await self.__run(self.container.load_fpd_file, model_id, fsname)
+
+    async def save_topic_model_file(self, model_id, lda, filename):
+        return await self.__run(self.container.save_topic_model_file, model_id, lda, filename)
+
+    async def save_target_layout_file(self, word_layout, model_id, fsname):
+        return await self.__run(self.container.save_target_layout_file, word_layout, model_id, fsname)
+
+    async def save_freq_model_file(self, model_id, fsname, hour, detector):
+        return await self.__run(self.container.save_freq_model_file, model_id, fsname, hour, detector)
+
+    async def load_freq_model_file(self, model_id, fsname, min_prob_dens) -> Dict[int, FrequencyDetector]:
+        return await self.__run(self.container.load_freq_model_file, model_id, fsname, min_prob_dens)
+
+    async def load_fbmodel_file(self, report_id, fsname):
+        return await self.__run(self.container.load_fbmodel_file, report_id, fsname)
+
+    async def save_model_contour(self, model_id, target_name, date, contour_data):
+        return await self.__run(self.container.save_model_contour, model_id, target_name, date, contour_data)
+
+    async def save_path_score(self, path_score_summary):
+        return await self.__run(self.container.save_path_score, path_score_summary)
+
+    async def save_freq_score(self, freq_score_summary):
+        return await self.__run(self.container.save_freq_score, freq_score_summary)
+
+    async def get_freq_score(self, fsname, date):
+        return await self.__run(self.container.get_freq_score, fsname, date)
+
+    async def delete_path_score(self, reportid):
+        return await self.__run(self.container.delete_path_score, reportid)
+
+    async def delete_freq_score(self, reportid):
+        return await self.__run(self.container.delete_freq_score, reportid)
+
+    async def delete_old_pathscore(self, detected_date, current_time, report_id):
+        return await self.__run(self.container.delete_old_pathscore, detected_date, current_time, report_id)
+
+    async def delete_old_freqscore(self, detected_date, current_time, report_id):
+        return await self.__run(self.container.delete_old_freqscore, detected_date, current_time, report_id)
+
+    async def get_reportmodel(self, report_id: int, risk_kind: int):
+        return await self.__run(self.container.get_reportmodel, report_id, risk_kind)
+
+    async def check_fpd_file(self, model_id: str, file_sys_name: str):
+        return await self.__run(self.container.check_fpd_file, model_id, file_sys_name)
+
+    async def set_dataset(self, logger, max_workers: int = None, max_bytes: int = None):
+        return await self.__run(self.container.set_dataset, logger, max_workers=max_workers, max_bytes=max_bytes)
+
+    async def load_model_bundle(self, model_id, min_prob_dens):
+        return await self.__run(self.container.load_model_bundle, model_id, min_prob_dens)
+
+    def get_target_model_dir_path(self, model_id: str, fsname: str):
+        return self.container.get_target_model_dir_path(model_id, fsname)
+
+    def get_target_model_path(self, model_id: str, fsname: str):
+        return self.container.get_target_model_path(model_id, fsname)
+
+    def get_models_dir_path(self, model_id):
+        return self.container.get_models_dir_path(model_id)
+
+    def get_file_sys_name(self, target_name=None):
+        return self.container.get_file_sys_name(target_name)
+
+    def get_target_name(self, file_sys_name=None):
+        return self.container.get_target_name(file_sys_name)
+
+
+async def run_targets(
+    session: AwsDataSourceSession,
+    target_names: Iterable[str],
+    func: Callable[[AsyncAwsDataSourceContainer], Awaitable[Any]],
+    concurrency: int = 16,
+    executor: Executor = None
+) -> List[Any]:
+    u"""
+        複数の対象について func を同じイベントループ上で並行に実行する。
+
+        Parameters
+        ----------
+            session : AwsDataSourceSession
+                開始済み(with の中)のセッション。スコアのアップロードはセッション終了時にまとめて行われる
+            func : AsyncAwsDataSourceContainer を受け取るコルーチン関数
+            concurrency : int
+                同時に処理する対象数の上限
+
+        Returns
+        -------
+            target_names と同じ順序の func の返り値のリスト
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(target_name):
+        async with semaphore:
+            async with AsyncAwsDataSourceContainer.from_session(
+                    session, target_name, executor=executor) as container:
+                return await func(container)
+
+    return await asyncio.gather(*[run(target_name) for target_name in target_names])
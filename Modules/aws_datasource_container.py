@@ -6,23 +6,176 @@ import shutil
 import json
 import pandas as pd
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 from typing import Tuple, List, Dict
 from Modules.detector.freq2 import FrequencyDetector, SaveData
 from Modules.datasource_container import IDataSourceContainer
+from Modules.s3_object_cache import S3ObjectCache
+from Modules.columnar_score_store import ColumnarScoreStore
+import Modules.model_bundle as model_bundle
+from Modules.streaming_data_source import CsvStreamSource, S3CsvStreamSource, LocalCsvStreamSource
 from model_db import AwsModelDb, ReportModelStatus
 import Modules.file_system_name_db as fileSysNameDb
 import score_db as scoredb
 import dill
 import boto3
 import tempfile
-import hashlib
 import logging
+import threading
+import time
+from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
+
+
+def _clean_temp_dir(model_cache: S3ObjectCache = None):
+    # Lambdaのインスタンスを使いまわした際に、前回実行時のファイルが残存している可能性がある
+    # ただし、モデルのキャッシュはインスタンスの使いまわし時に再利用したいので残す
+    exclude = os.path.abspath(model_cache.cache_dir) if model_cache is not None else None
+    for file in os.listdir(tempfile.gettempdir()):
+        path = os.path.join(tempfile.gettempdir(), file)
+        if os.path.abspath(path) == exclude:
+            continue
+        try:
+            shutil.rmtree(path)
+        except OSError:
+            os.remove(path)
+
+
+# スコアファイルのアップロード時に指定できる圧縮形式と、キーに付ける拡張子
+SCORE_COMPRESSIONS = {
+    "gzip": ".gz",
+    "zstd": ".zst",
+    "parquet": ".parquet",
+}
+
+
+def _encode_score_file(local_path: str, key: str, compression: str) -> Tuple[bytes, str]:
+    u"""
+        スコアのCSVファイルを指定の形式に変換し、(本体, アップロード先のキー)を返す。
+    """
+    if compression == "parquet":
+        import pyarrow.csv as pacsv
+        import pyarrow.parquet as pq
+        buffer = io.BytesIO()
+        pq.write_table(pacsv.read_csv(local_path), buffer, compression="zstd")
+        if key.endswith(".csv"):
+            key = key[:-len(".csv")]
+        return buffer.getvalue(), key + SCORE_COMPRESSIONS[compression]
+
+    with open(local_path, "rb") as f:
+        data = f.read()
+    if compression == "gzip":
+        import gzip
+        return gzip.compress(data), key + SCORE_COMPRESSIONS[compression]
+    if compression == "zstd":
+        # zstandardはオプションの依存パッケージ
+        import zstandard
+        return zstandard.ZstdCompressor().compress(data), key + SCORE_COMPRESSIONS[compression]
+    raise ValueError(f"unknown score compression: {compression}")
+
+
+def _upload_score_files(
+    s3,
+    bucket_name: str,
+    uploads: List[Tuple[str, str]],
+    compression: str = None,
+    max_workers: int = 8,
+    retries: int = 3
+):
+    u"""
+        スコアファイルをスレッドプールで並列にS3へアップロードする。
+        失敗したファイルは retries 回まで再試行し、それでも失敗した場合は最後の例外を送出する。
+        進捗とスループットはloggingに出力する。
+
+        Parameters
+        ----------
+            uploads : list of tuple(local_path: str, key: str)
+            compression : str, optional
+                None の場合はCSVのままアップロードする。
+                "gzip", "zstd", "parquet" を指定すると変換してアップロードし、キーの拡張子を変える。
+    """
+    if not uploads:
+        return
+    if compression is not None and compression not in SCORE_COMPRESSIONS:
+        raise ValueError(f"unknown score compression: {compression}")
+
+    transfer_config = TransferConfig(
+        multipart_threshold=AwsDataSourceContainer.SCORE_MULTIPART_THRESHOLD,
+        multipart_chunksize=AwsDataSourceContainer.SCORE_MULTIPART_THRESHOLD,
+        max_concurrency=1)
+    progress_lock = threading.Lock()
+    progress = {"files": 0, "bytes": 0}
+    started = time.monotonic()
+
+    def upload(local_path, key):
+        for attempt in range(retries + 1):
+            try:
+                if compression is None:
+                    size = os.path.getsize(local_path)
+                    s3.upload_file(local_path, bucket_name, key, Config=transfer_config)
+                else:
+                    body, compressed_key = _encode_score_file(local_path, key, compression)
+                    size = len(body)
+                    s3.upload_fileobj(io.BytesIO(body), bucket_name, compressed_key, Config=transfer_config)
+                break
+            except Exception as e:
+                if attempt >= retries:
+                    raise
+                logging.warning(f"retry uploading score. [key: {key}][attempt: {attempt + 1}][error: {str(e)}]")
+                time.sleep(0.5 * 2 ** attempt)
+
+        with progress_lock:
+            progress["files"] += 1
+            progress["bytes"] += size
+            if progress["files"] % 100 == 0:
+                logging.info(f"uploading scores. [{progress['files']}/{len(uploads)} files][{progress['bytes']} byte]")
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(uploads)))) as executor:
+        futures = [executor.submit(upload, local_path, key) for local_path, key in uploads]
+        for future in futures:
+            future.result()
+
+    elapsed = time.monotonic() - started
+    throughput = progress["bytes"] / elapsed / 1048576 if elapsed > 0 else 0
+    logging.info(f"end uploading scores. [files: {progress['files']}][size: {progress['bytes']} byte][elapsed: {elapsed:.2f} s][throughput: {throughput:.2f} MB/s]")
+
+
+class _PrefixListingCache(object):
+    u"""
+        S3のプレフィックスのリスティング結果をプロセス内で保持する。
+    """
+
+    def __init__(self):
+        self.__listings: Dict[str, List[str]] = {}
+        self.__lock = threading.Lock()
+
+    def get_or_list(self, prefix: str, list_func) -> List[str]:
+        with self.__lock:
+            if prefix not in self.__listings:
+                self.__listings[prefix] = list_func(prefix)
+            return self.__listings[prefix]
+
+    def clear(self):
+        with self.__lock:
+            self.__listings.clear()
 
 
 class AwsDataSourceContainer(IDataSourceContainer):
     # Lambda関数のエフェメラルストレージ上限は10GBだが、若干余裕を持たせて8GBを上限に(byte換算)。
     MAX_STORAGE_SIZE = 8589934592
+    # 24時間分のモデルを並列にダウンロードする際のスレッド数
+    MODEL_DOWNLOAD_WORKERS = 8
+    # 学習データを並列にダウンロードする際のスレッド数
+    DATASET_DOWNLOAD_WORKERS = 8
+    # この大きさ以上の学習データは範囲指定のマルチパート転送でダウンロードする
+    DATASET_MULTIPART_THRESHOLD = 67108864  # 64MB
+    DATASET_MULTIPART_CHUNKSIZE = 16777216  # 16MB
+    DATASET_MULTIPART_CONCURRENCY = 4
+    # スコアファイルのアップロード設定
+    SCORE_UPLOAD_WORKERS = 8
+    SCORE_UPLOAD_RETRIES = 3
+    SCORE_MULTIPART_THRESHOLD = 16777216  # 16MB
 
     def __init__(
         self,
@@ -35,10 +188,28 @@ class AwsDataSourceContainer(IDataSourceContainer):
         table_name: str,
         target_name: str,
         path_temp_score_db_key=None,
-        freq_temp_score_db_key=None
+        freq_temp_score_db_key=None,
+        session=None,
+        model_cache: S3ObjectCache = None,
+        score_compression: str = None,
+        out_of_band_models: bool = False
     ):
         u"""
             AWS用のデータアクセス
+
+            Parameters
+            ----------
+                session : AwsDataSourceSession, optional
+                    指定した場合、S3クライアントと一時ディレクトリをセッションと共有する。
+                    通常は AwsDataSourceSession.container から生成する。
+                model_cache : S3ObjectCache, optional
+                    指定した場合、モデルファイルの読み込みをこのキャッシュ経由で行う。
+                score_compression : str, optional
+                    スコアファイルのアップロード形式。"gzip", "zstd", "parquet" のいずれか。
+                    指定しない場合はCSVのままアップロードする。
+                out_of_band_models : bool, default False
+                    True の場合、頻度モデルを pickle プロトコル 5 の out-of-band 形式で保存する
+                    (SaveData.dumps を参照)。ロードはどちらの形式でも行える。
         """
 
         self.src_bucket_name = src_bucket_name
@@ -53,34 +224,109 @@ class AwsDataSourceContainer(IDataSourceContainer):
         self.old_model_target_name = ""
         self.path_temp_score_db_key = path_temp_score_db_key
         self.freq_temp_score_db_key = freq_temp_score_db_key
+        self.session = session
+        self.model_cache = model_cache
+        self.score_compression = score_compression
+        self.out_of_band_models = out_of_band_models
+        self.__s3_client = None
+        self.__s3_resource = None
+        self.__s3_client_lock = threading.Lock()
+        self.__listing_cache = _PrefixListingCache()
 
     def __enter__(self):
-        self.aws_score_db = scoredb.AwsScoreDb(
-            os.path.join(tempfile.gettempdir(), 'ALog'))
-        # Lambdaのインスタンスを使いまわした際に、前回実行時のファイルが残存している可能性がある
-        for file in os.listdir(tempfile.gettempdir()):
-            path = os.path.join(tempfile.gettempdir(), file)
-            try:
-                shutil.rmtree(path)
-            except OSError:
-                os.remove(path)
+        if self.session is None:
+            self.aws_score_db = scoredb.AwsScoreDb(
+                os.path.join(tempfile.gettempdir(), 'ALog'))
+            _clean_temp_dir(self.model_cache)
+        else:
+            # 一時ディレクトリの掃除はセッション開始時に一度だけ行われる
+            # スコアのファイル名は日付のみなので、対象ごとに出力先を分ける
+            self.aws_score_db = scoredb.AwsScoreDb(
+                os.path.join(tempfile.gettempdir(), 'ALog', self.get_file_sys_name()))
         return self
 
     def __exit__(self, ex_type, ex_value, trace):
-        if not os.path.isdir(self.aws_score_db.output_dir):
+        if self.model_cache is not None and self.session is None:
+            self.model_cache.save_index()
+        if self.session is not None:
+            # アップロードはセッション終了時にまとめて行う
+            self.session.add_uploads(self.collect_score_uploads())
+            # 学習データは不要になるので、次の対象のためにエフェメラルストレージを空けておく
+            shutil.rmtree(
+                os.path.join(tempfile.gettempdir(), self.base_data_key, self.get_file_sys_name()),
+                ignore_errors=True)
             return
-        s3 = boto3.client('s3')
+        _upload_score_files(
+            self._get_s3_client(),
+            self.src_bucket_name,
+            self.collect_score_uploads(),
+            compression=self.score_compression,
+            max_workers=self.SCORE_UPLOAD_WORKERS,
+            retries=self.SCORE_UPLOAD_RETRIES)
+
+    def collect_score_uploads(self) -> List[Tuple[str, str]]:
+        u"""
+            Returns
+            -------
+                S3へアップロードするスコアファイルのリスト : list of tuple(local_path: str, key: str)
+        """
+        uploads = []
+        if not os.path.isdir(self.aws_score_db.output_dir):
+            return uploads
         for kind in os.listdir(self.aws_score_db.output_dir):
             if kind == 'path':
                 for file in os.listdir(os.path.join(self.aws_score_db.output_dir, kind)):
                     date = file.rstrip(".csv")
-                    s3.upload_file(os.path.join(self.aws_score_db.output_dir, kind, file), self.src_bucket_name,
-                                   self.__get_temp_path_score_path(date, self.get_file_sys_name()))
+                    uploads.append((os.path.join(self.aws_score_db.output_dir, kind, file),
+                                    self.__get_temp_path_score_path(date, self.get_file_sys_name())))
             if kind == 'freq':
                 for file in os.listdir(os.path.join(self.aws_score_db.output_dir, kind)):
                     date = file.rstrip(".csv")
-                    s3.upload_file(os.path.join(self.aws_score_db.output_dir, kind, file), self.src_bucket_name,
-                                   self.__get_temp_freq_score_path(date, self.get_file_sys_name()))
+                    uploads.append((os.path.join(self.aws_score_db.output_dir, kind, file),
+                                    self.__get_temp_freq_score_path(date, self.get_file_sys_name())))
+        return uploads
+
+    def export_columnar_scores(self, score_store: ColumnarScoreStore):
+        u"""
+            score_db が出力したこの対象のスコアのCSVを、日付・対象で分割した Parquet として書き込む。
+        """
+        if not os.path.isdir(self.aws_score_db.output_dir):
+            return
+        for kind in os.listdir(self.aws_score_db.output_dir):
+            if kind not in ColumnarScoreStore.KINDS:
+                continue
+            for file in os.listdir(os.path.join(self.aws_score_db.output_dir, kind)):
+                date = file.rstrip(".csv")
+                score_store.write_csv(
+                    kind, date, self.get_file_sys_name(),
+                    os.path.join(self.aws_score_db.output_dir, kind, file))
+
+    def _get_s3_client(self):
+        if self.session is not None:
+            return self.session.s3_client
+        # デフォルトセッションでのクライアントの作成はスレッドセーフではないので、作成は1回だけにする
+        with self.__s3_client_lock:
+            if self.__s3_client is None:
+                self.__s3_client = boto3.client('s3')
+            return self.__s3_client
+
+    def __read_model_object(self, key: str, s3=None):
+        if s3 is None:
+            s3 = self._get_s3_client()
+        if self.model_cache is not None:
+            return self.model_cache.get(s3, self.src_bucket_name, key)
+        data = io.BytesIO()
+        s3.download_fileobj(self.src_bucket_name, key, data)
+        # getvalue はコピーになるので内部のバッファをそのまま返す。
+        # out-of-band 形式の頻度モデルは、配列がこのバッファを直接参照する
+        return data.getbuffer()
+
+    def _get_s3_resource(self):
+        if self.session is not None:
+            return self.session.s3_resource
+        if self.__s3_resource is None:
+            self.__s3_resource = boto3.resource('s3')
+        return self.__s3_resource
 
     def save_model_data(self, status):
         # モデル情報の保存は別の場所で行う
@@ -98,29 +344,22 @@ class AwsDataSourceContainer(IDataSourceContainer):
 
         dill_buffer = io.BytesIO()
         dill.dump(fpd_detector, dill_buffer)
-        s3 = boto3.resource('s3')
+        s3 = self._get_s3_resource()
         s3.Bucket(self.src_bucket_name).put_object(
             Key=detectorpath, Body=dill_buffer.getvalue())
 
     def load_fpd_file(self, model_id, fsname):
         path = self.get_target_model_path(model_id, self.get_file_sys_name())
-        with io.BytesIO() as data:
-            s3 = boto3.resource('s3')
-            try:
-                s3.Bucket(self.src_bucket_name).download_fileobj(path, data)
-                data.seek(0)
-                return dill.load(data)
-            except Exception as e:
-                pass
+        try:
+            return dill.loads(self.__read_model_object(path))
+        except Exception as e:
+            pass
         # 59048の修正後に学習を行っていない場合、古いモデルを読み込む必要がある
         old_path = self.get_target_model_path(model_id, self.__get_old_model_target_name(model_id))
-        with io.BytesIO() as old_data:
-            try:
-                s3.Bucket(self.src_bucket_name).download_fileobj(old_path, old_data)
-                old_data.seek(0)
-                return dill.load(old_data)
-            except Exception as e:
-                return None
+        try:
+            return dill.loads(self.__read_model_object(old_path))
+        except Exception as e:
+            return None
 
     def save_topic_model_file(self, model_id, lda, filename):
         # ここでは実装しない
@@ -138,11 +377,9 @@ class AwsDataSourceContainer(IDataSourceContainer):
         )
         savedata = SaveData(detector)
 
-        dill_buffer = io.BytesIO()
-        dill.dump(savedata, dill_buffer)
-        s3 = boto3.resource('s3')
+        s3 = self._get_s3_resource()
         s3.Bucket(self.src_bucket_name).put_object(
-            Key=model_path, Body=dill_buffer.getvalue())
+            Key=model_path, Body=savedata.dumps(out_of_band=self.out_of_band_models))
 
     def load_freq_model_file(
         self,
@@ -151,67 +388,155 @@ class AwsDataSourceContainer(IDataSourceContainer):
         min_prob_dens
     ) -> Dict[int, FrequencyDetector]:
         self.model_target_name = self.__get_model_target_name(model_id)
-        s3 = boto3.resource('s3')
+
+        hours = list(range(0, 24))
+        savedatas = self.__download_freq_models(
+            model_id, self.model_target_name, hours, "model")
+        failed_hours = [hour for hour in hours if hour not in savedatas]
+        if failed_hours:
+            # 59048の修正後に学習を行っていない場合、古いモデルを読み込む必要がある
+            # 古いモデル名の解決にはS3のリスティングが必要なので、呼び出しごとに一度だけ行う
+            old_model_target_name = self.__get_old_model_target_name(model_id)
+            savedatas.update(self.__download_freq_models(
+                model_id, old_model_target_name, failed_hours, "OLD model"))
+            for hour in failed_hours:
+                if hour not in savedatas:
+                    logging.info(f"DEBUG: load_freq_model_file: No model found for hour {hour}, model_id: {model_id}, target_name: {self.model_target_name}.")
+                    return
 
         detectors = {}
-        for hour in range(0, 24):
-            try:
-                model_path = self.__get_usermodel_filepath(
-                    model_id, self.model_target_name, hour)
-                with io.BytesIO() as data:
-                    s3.Bucket(self.src_bucket_name).download_fileobj(
-                        model_path, data)
-                    data.seek(0)
-                    savedata = dill.load(data)
-            except Exception as e:
-                logging.warning(f"DEBUG: load_freq_model_file: Failed to load model: {str(e)}")
-                # 59048の修正後に学習を行っていない場合、古いモデルを読み込む必要がある
+        for hour in hours:
+            detector = FrequencyDetector(
+                min_prob_dens=min_prob_dens
+            )
+            savedatas[hour].set_params(detector)
+            detectors[hour] = detector
+        return detectors
+
+    def __download_freq_models(
+        self,
+        model_id,
+        model_target_name: str,
+        hours: List[int],
+        label: str
+    ) -> Dict[int, SaveData]:
+        u"""
+            指定した時間帯のモデルを並列にダウンロードしてロードする。
+            ロードに失敗した時間帯は返り値に含まれない。
+        """
+        # クライアントはスレッドプールを作る前に取得し、すべてのスレッドで共有する
+        s3 = self._get_s3_client()
+
+        def download(hour):
+            model_path = self.__get_usermodel_filepath(
+                model_id, model_target_name, hour)
+            return SaveData.loads(self.__read_model_object(model_path, s3))
+
+        savedatas = {}
+        max_workers = max(1, min(len(hours), self.MODEL_DOWNLOAD_WORKERS))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(download, hour): hour for hour in hours}
+            for future, hour in futures.items():
                 try:
-                    model_path = self.__get_usermodel_filepath(
-                        model_id, self.__get_old_model_target_name(model_id), hour)
-                    with io.BytesIO() as data:
-                        s3.Bucket(self.src_bucket_name).download_fileobj(
-                            model_path, data)
-                        data.seek(0)
-                        savedata = dill.load(data)
+                    savedatas[hour] = future.result()
                 except Exception as e:
-                    logging.warning(f"DEBUG: load_freq_model_file: Failed to load OLD model: {str(e)}")
-                    logging.info(f"DEBUG: load_freq_model_file: No model found for hour {hour}, model_id: {model_id}, target_name: {self.model_target_name}.")
-                    return
-            if not model_path:
-                detectors[hour] = None
-                continue
+                    logging.warning(f"DEBUG: load_freq_model_file: Failed to load {label}: {str(e)}")
+        return savedatas
+
+    def get_target_model_bundle_path(self, model_id: str, fsname: str) -> str:
+        return model_bundle.get_bundle_key(self.get_target_model_dir_path(model_id, fsname))
+
+    def save_model_bundle(self, model_id, report_id=None):
+        u"""
+            この対象の従来のキー配置のモデルをまとめたバンドルを作成して保存する。
+            モデルを保存し直した後に呼ぶと、バンドルも最新になる。
+        """
+        fsname = self.get_file_sys_name()
+        fbmodel_path = None
+        if report_id is not None:
+            fbmodel_path = self.__get_fbmodel_filepath(str(report_id), fsname)
+        s3 = self._get_s3_client()
+        sources = {}
+        entries = model_bundle.collect_target_entries(
+            s3, self.src_bucket_name, self.get_target_model_dir_path(model_id, fsname), fbmodel_path,
+            sources=sources)
+        s3.put_object(
+            Bucket=self.src_bucket_name,
+            Key=self.get_target_model_bundle_path(model_id, fsname),
+            Body=model_bundle.build_bundle(entries, sources))
+
+    def load_model_bundle(self, model_id, min_prob_dens) -> Dict:
+        u"""
+            この対象のバンドルを1回のGETで読み込む。
+
+            バンドルは作成時点のコピーなので、読み込み後に従来のキーのリスティング(とフィードバックモデルの HEAD)で
+            作成時の ETag と一致するかを確かめる(model_bundle.is_bundle_current)。
+            save_fpd_file などで作成後にモデルが更新されていた場合は古いバンドルとして None を返す。
+            バンドル作成後に新しく作られたフィードバックモデルは検出できないので、
+            "fbmodel" が None の場合は load_fbmodel_file を使うこと。
+
+            Returns
+            -------
+                {"fpd": pathdetector, "freq": {hour: FrequencyDetector}, "fbmodel": feedbackmodel}
+                含まれないモデルは None になる。頻度モデルは24時間分揃っていない場合 None。
+                バンドルが存在しないか古い場合は None を返すので、従来の load_* を使うこと。
+        """
+        s3 = self._get_s3_client()
+        fsname = self.get_file_sys_name()
+        reader = model_bundle.ModelBundleReader(
+            s3,
+            self.src_bucket_name,
+            self.get_target_model_bundle_path(model_id, fsname))
+        try:
+            entries = reader.read_all()
+        except Exception as e:
+            logging.info(f"DEBUG: load_model_bundle: No bundle found: {str(e)}")
+            return None
+        if not model_bundle.is_bundle_current(
+                s3, self.src_bucket_name, self.get_target_model_dir_path(model_id, fsname), reader.sources()):
+            logging.info(f"DEBUG: load_model_bundle: Bundle is stale. model_id: {model_id}, fsname: {fsname}")
+            return None
+
+        def load(name):
+            if name not in entries:
+                return None
+            return dill.loads(entries[name])
+
+        detectors = {}
+        for hour in range(0, 24):
+            savedata = SaveData.loads(entries[str(hour)]) if str(hour) in entries else None
+            if savedata is None:
+                detectors = None
+                break
             detector = FrequencyDetector(
                 min_prob_dens=min_prob_dens
             )
             savedata.set_params(detector)
             detectors[hour] = detector
-        return detectors
+
+        return {
+            "fpd": load("pathdetector"),
+            "freq": detectors,
+            "fbmodel": load(model_bundle.FBMODEL_ENTRY),
+        }
 
     def load_fbmodel_file(self, report_id, fsname):
         path = self.__get_fbmodel_filepath(report_id, self.get_file_sys_name())
-        s3 = boto3.resource('s3')
-        with io.BytesIO() as data:
-            try:
-                s3.Bucket(self.src_bucket_name).download_fileobj(path, data)
-                data.seek(0)
-                return dill.load(data)
-            except:
-                pass
+        try:
+            return dill.loads(self.__read_model_object(path))
+        except:
+            pass
         # 59048の修正後に学習を行っていない場合、古いモデルを読み込む必要がある
         old_path = self.__get_fbmodel_filepath(report_id, self.old_model_target_name)
-        with io.BytesIO() as old_data:
-            try:
-                s3.Bucket(self.src_bucket_name).download_fileobj(old_path, old_data)
-                old_data.seek(0)
-                return dill.load(old_data)
-            except:
-                return None
+        try:
+            return dill.loads(self.__read_model_object(old_path))
+        except:
+            return None
 
     def save_model_contour(self, model_id, target_name, date, contour_data):
         data_path = self.__get_freq_contour_filepath(model_id, self.get_file_sys_name(), date)
 
-        s3 = boto3.resource('s3')
+        s3 = self._get_s3_resource()
         bucket = s3.Bucket(self.src_bucket_name)
         obj = bucket.Object(data_path)
         obj.put(Body=json.dumps(contour_data))
@@ -357,9 +682,9 @@ class AwsDataSourceContainer(IDataSourceContainer):
     # Cloudではハッシュ名で扱う
     def get_file_sys_name(self, target_name=None):
         if target_name == None:
-            return hashlib.sha1(self.target_name.lower().encode()).hexdigest()
+            return fileSysNameDb.hash_target_name(self.target_name)
         else:
-            return hashlib.sha1(target_name.lower().encode()).hexdigest()
+            return fileSysNameDb.hash_target_name(target_name)
 
     def get_target_name(self, file_sys_name=None):
         return self.target_name
@@ -388,26 +713,28 @@ class AwsDataSourceContainer(IDataSourceContainer):
                 return s3_target_name
         return ""
 
-    def __get_all_folders(self, prefix: str, keys: List = None, marker: str = ''):
-        s3 = boto3.client('s3')
-        response = s3.list_objects(
-            Bucket=self.src_bucket_name, Prefix=prefix, Marker=marker, Delimiter='/')
-
-        if keys is None:
-            keys = []
-
-        if 'CommonPrefixes' in response:
+    def __get_all_folders(self, prefix: str) -> List[str]:
+        u"""
+            prefix直下のフォルダ(CommonPrefixes)を全て返す。
+            古いモデル名の解決にのみ使われ、59048修正前のフォルダが新たに作られることはないため、
+            結果はプレフィックスごとにキャッシュする(セッション使用時はセッション全体で共有)。
+        """
+        listing_cache = self.session.listing_cache if self.session is not None else self.__listing_cache
+        return listing_cache.get_or_list(prefix, self.__list_folders)
+
+    def __list_folders(self, prefix: str) -> List[str]:
+        s3 = self._get_s3_client()
+        paginator = s3.get_paginator('list_objects_v2')
+        keys = []
+        for response in paginator.paginate(
+                Bucket=self.src_bucket_name, Prefix=prefix, Delimiter='/'):
             keys.extend([content['Prefix']
-                        for content in response['CommonPrefixes']])
-        if 'Contents' in response:
-            last_file_key = response['Contents'][-1]['Key']
-            if 'IsTruncated' in response:
-                return self.__get_all_folders(prefix=prefix, keys=keys, marker=last_file_key)
+                        for content in response.get('CommonPrefixes', [])])
         return keys
 
     def check_fpd_file(self, model_id, fsname):
         self.model_target_name = self.__get_model_target_name(model_id)
-        s3 = boto3.resource('s3')
+        s3 = self._get_s3_resource()
         bucket = s3.Bucket(self.src_bucket_name)
         prefix = self.get_target_model_dir_path(model_id, self.model_target_name) + "/"
         objs = bucket.objects.filter(Prefix=prefix)
@@ -421,29 +748,218 @@ class AwsDataSourceContainer(IDataSourceContainer):
                 return True
             return False
 
-    def set_dataset(self, logger):
-        s3 = boto3.resource('s3')
+    def set_dataset(
+        self,
+        logger,
+        max_workers: int = None,
+        max_bytes: int = None
+    ):
+        u"""
+            対象の学習データを新しい日付のものから優先してエフェメラルストレージにダウンロードする。
+
+            Parameters
+            ----------
+                logger : logging.Logger
+                max_workers : int, optional
+                    並列にダウンロードするファイル数。デフォルトは DATASET_DOWNLOAD_WORKERS
+                max_bytes : int, optional
+                    ダウンロードするデータの合計サイズの上限(byte)。
+                    指定してもエフェメラルストレージの上限(MAX_STORAGE_SIZE)を超えることはない。
+
+            Notes
+            -----
+                ダウンロード対象はリスティング時のサイズで先に決定し、新しい日付のものから順に
+                スレッドプールへ投入する。大きなCSVは範囲指定のマルチパート転送で取得する。
+        """
+        s3 = self._get_s3_resource()
         bucket = s3.Bucket(self.src_bucket_name)
+        client = self._get_s3_client()
+        if max_workers is None:
+            max_workers = self.DATASET_DOWNLOAD_WORKERS
 
         local_dir = os.path.join(tempfile.gettempdir(), self.base_data_key, self.get_file_sys_name())
         os.makedirs(local_dir, exist_ok=True)
         size = 0
+        # モデルのキャッシュもエフェメラルストレージを使うので、その分を差し引く
+        max_storage_size = self.MAX_STORAGE_SIZE
+        if self.model_cache is not None:
+            max_storage_size -= self.model_cache.max_disk_bytes
+        if max_bytes is not None:
+            max_storage_size = min(max_storage_size, max_bytes)
         objs_descending_by_date = sorted(bucket.objects.filter(Prefix=self.base_data_key+f"/{self.get_file_sys_name()}/"), key=lambda o: o.key.split("/")[-1], reverse=True)
 
+        download_objs = []
         for obj in objs_descending_by_date:
             key = obj.key
             if key[-1] == "/":
                 # フォルダなのでskip
                 continue
 
-            if size + obj.size > self.MAX_STORAGE_SIZE:
+            if size + obj.size > max_storage_size:
                 logger.info(f"skip data due to exceeding the capacity of ephemeral storage. [target_name: {self.target_name}][obj_key: {key}][obj_size: {obj.size} byte][stored_size: {size} byte]")
             else:
-                filename = key.split("/")[-1]
-                logger.info(f"start downloading data. [target_name: {self.target_name}][obj_key: {key}][obj_size: {obj.size} byte]")
+                size += obj.size
+                download_objs.append((key, obj.size))
+
+        transfer_config = TransferConfig(
+            multipart_threshold=self.DATASET_MULTIPART_THRESHOLD,
+            multipart_chunksize=self.DATASET_MULTIPART_CHUNKSIZE,
+            max_concurrency=self.DATASET_MULTIPART_CONCURRENCY)
+        stored_size_lock = threading.Lock()
+        stored_size = [0]
+
+        def download(key, obj_size):
+            filename = key.split("/")[-1]
+            logger.info(f"start downloading data. [target_name: {self.target_name}][obj_key: {key}][obj_size: {obj_size} byte]")
+
+            local_filepath = os.path.join(local_dir, filename)
+            client.download_file(self.src_bucket_name, key, local_filepath, Config=transfer_config)
+
+            with stored_size_lock:
+                stored_size[0] += obj_size
+                current_size = stored_size[0]
+            logger.info(f"end downloadeing data. [target_name: {self.target_name}][obj_key: {key}][obj_size: {obj_size} byte][stored_size: {current_size} byte]")
+
+        # ThreadPoolExecutorは投入順に処理するので、新しい日付のものから先にダウンロードされる
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            futures = [executor.submit(download, key, obj_size) for key, obj_size in download_objs]
+            for future in futures:
+                future.result()
+
+    def get_dataset_stream(self, local_dir: str = None, **kwargs) -> CsvStreamSource:
+        u"""
+            set_dataset の代わりに、学習データをエフェメラルストレージに保存せず
+            チャンクごとに読み込むデータソースを返す。
 
-                local_filepath = os.path.join(local_dir, filename)
-                bucket.download_file(key, local_filepath)
+            Parameters
+            ----------
+                local_dir : str, optional
+                    指定した場合、S3ではなくこのディレクトリ配下のCSVを読み込む
+                kwargs :
+                    CsvStreamSource の block_size, encoding
+        """
+        if local_dir is not None:
+            return LocalCsvStreamSource(local_dir, **kwargs)
+        return S3CsvStreamSource(
+            self._get_s3_client(),
+            self.src_bucket_name,
+            self.base_data_key + f"/{self.get_file_sys_name()}/",
+            **kwargs)
+
+
+class AwsDataSourceSession(object):
+    u"""
+        1プロセスで複数の対象(target_name)を扱うためのセッション。
+        S3クライアントとコネクションプールを各 AwsDataSourceContainer で共有し、
+        一時ディレクトリの掃除はセッション開始時に一度だけ、スコアのアップロードは
+        セッション終了時にまとめて行う。
+
+        with AwsDataSourceSession(...) as session:
+            for target_name in target_names:
+                with session.container(target_name) as container:
+                    ...
+    """
+
+    MAX_POOL_CONNECTIONS = 50
 
-                size += obj.size
-                logger.info(f"end downloadeing data. [target_name: {self.target_name}][obj_key: {key}][obj_size: {obj.size} byte][stored_size: {size} byte]")
+    def __init__(
+        self,
+        src_bucket_name: str,
+        base_system_key: str,
+        base_data_key: str,
+        aws_id: str,
+        mgmt_id: str,
+        report_id,
+        table_name: str,
+        path_temp_score_db_key=None,
+        freq_temp_score_db_key=None,
+        max_pool_connections: int = MAX_POOL_CONNECTIONS,
+        model_cache: S3ObjectCache = None,
+        score_compression: str = None,
+        out_of_band_models: bool = False
+    ):
+        self.src_bucket_name = src_bucket_name
+        self.base_system_key = base_system_key
+        self.base_data_key = base_data_key
+        self.aws_id = aws_id
+        self.mgmt_id = mgmt_id
+        self.report_id = report_id
+        self.table_name = table_name
+        self.path_temp_score_db_key = path_temp_score_db_key
+        self.freq_temp_score_db_key = freq_temp_score_db_key
+        self.max_pool_connections = max_pool_connections
+        self.model_cache = model_cache
+        self.score_compression = score_compression
+        self.out_of_band_models = out_of_band_models
+        self.listing_cache = _PrefixListingCache()
+
+        self.__boto3_session = boto3.session.Session()
+        self.__s3_client = None
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        self.__uploads = []
+
+    def __enter__(self):
+        _clean_temp_dir(self.model_cache)
+        return self
+
+    def __exit__(self, ex_type, ex_value, trace):
+        if self.model_cache is not None:
+            self.model_cache.save_index()
+        self.upload_all()
+
+    @property
+    def s3_client(self):
+        # boto3のクライアントはスレッドセーフなので、プロセス内で1つを共有する
+        with self.__lock:
+            if self.__s3_client is None:
+                self.__s3_client = self.__boto3_session.client(
+                    's3', config=Config(max_pool_connections=self.max_pool_connections))
+            return self.__s3_client
+
+    @property
+    def s3_resource(self):
+        # リソースはスレッドセーフではないのでスレッドごとに作る
+        resource = getattr(self.__local, 's3_resource', None)
+        if resource is None:
+            resource = boto3.session.Session().resource(
+                's3', config=Config(max_pool_connections=self.max_pool_connections))
+            self.__local.s3_resource = resource
+        return resource
+
+    def container(self, target_name: str) -> AwsDataSourceContainer:
+        return AwsDataSourceContainer(
+            self.src_bucket_name,
+            self.base_system_key,
+            self.base_data_key,
+            self.aws_id,
+            self.mgmt_id,
+            self.report_id,
+            self.table_name,
+            target_name,
+            path_temp_score_db_key=self.path_temp_score_db_key,
+            freq_temp_score_db_key=self.freq_temp_score_db_key,
+            session=self,
+            model_cache=self.model_cache,
+            score_compression=self.score_compression,
+            out_of_band_models=self.out_of_band_models
+        )
+
+    def add_uploads(self, uploads: List[Tuple[str, str]]):
+        with self.__lock:
+            self.__uploads.extend(uploads)
+
+    def upload_all(self):
+        u"""
+            セッション中に各対象から登録されたスコアファイルをまとめてS3へアップロードする。
+        """
+        with self.__lock:
+            uploads = self.__uploads
+            self.__uploads = []
+        _upload_score_files(
+            self.s3_client,
+            self.src_bucket_name,
+            uploads,
+            compression=self.score_compression,
+            max_workers=self.max_pool_connections,
+            retries=AwsDataSourceContainer.SCORE_UPLOAD_RETRIES)
@@ -0,0 +1,135 @@
+import os
+from datetime import date as date_type, datetime
+from typing import Iterable, List, Union
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+
+class ColumnarScoreStore(object):
+    u"""
+        パススコア・頻度スコアを Parquet で保持するストア。
+        {root}/{kind}/date={YYYYMMDD}/target={file_sys_name}/part-0.parquet
+        の形で日付と対象ごとにパーティション分割し、文字列のカラム(パスなど)は辞書エンコードする。
+        読み込み時は日付と対象の条件をパーティションの絞り込み(述語プッシュダウン)として適用するので、
+        1レポート分1か月のスコアなども、該当するファイルだけを読み込める。
+
+        filesystem に pyarrow.fs.S3FileSystem を渡せば、S3上のデータセットをそのまま扱える。
+    """
+
+    KINDS = ("path", "freq")
+    PARTITIONING = ds.partitioning(
+        pa.schema([("date", pa.string()), ("target", pa.string())]), flavor="hive")
+
+    def __init__(self, root: str, filesystem=None):
+        self.root = root.rstrip("/")
+        self.filesystem = filesystem
+
+    def write_table(self, kind: str, date, target: str, table: pa.Table):
+        u"""
+            1日分・1対象分のスコアを書き込む。同じパーティションがあれば上書きする。
+
+            Parameters
+            ----------
+                kind : str
+                    "path" もしくは "freq"
+                date : date or str
+                    スコアの日付。文字列の場合は YYYYMMDD
+                target : str
+                    対象のファイルシステム上の名前
+                table : pyarrow.Table
+        """
+        self.__check_kind(kind)
+        table = self.__dictionary_encode(table)
+        path = "/".join([
+            self.__kind_root(kind),
+            f"date={self.__format_date(date)}",
+            f"target={target}",
+            "part-0.parquet"])
+        if self.filesystem is None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 読み込み途中のファイルが見えないよう、一時ファイルに書いてからリネームする
+            # ("."で始まるファイルはデータセットの探索対象から除外される)
+            tmp_path = os.path.join(os.path.dirname(path), ".part-0.parquet.tmp")
+            pq.write_table(table, tmp_path)
+            os.replace(tmp_path, path)
+        else:
+            self.filesystem.create_dir(path.rsplit("/", 1)[0], recursive=True)
+            pq.write_table(table, path, filesystem=self.filesystem)
+
+    def write_csv(self, kind: str, date, target: str, csv_path: str):
+        u"""
+            score_db が出力したスコアのCSVファイルを変換して書き込む。
+            数値のカラムは型推論された数値型のまま保持される。
+        """
+        self.write_table(kind, date, target, pacsv.read_csv(csv_path))
+
+    def read(
+        self,
+        kind: str,
+        targets: Iterable[str] = None,
+        start_date=None,
+        end_date=None,
+        columns: List[str] = None
+    ) -> pa.Table:
+        u"""
+            条件に合うスコアを読み込む。
+
+            Parameters
+            ----------
+                targets : list of str, optional
+                    対象のファイルシステム上の名前。指定しない場合は全対象
+                start_date, end_date : date or str, optional
+                    日付の範囲(両端を含む)
+                columns : list of str, optional
+                    読み込むカラム。date, target のパーティションカラムも指定できる
+
+            Returns
+            -------
+                pyarrow.Table。date, target カラムが付加される。
+        """
+        self.__check_kind(kind)
+        dataset = ds.dataset(
+            self.__kind_root(kind),
+            format="parquet",
+            partitioning=self.PARTITIONING,
+            filesystem=self.filesystem,
+            exclude_invalid_files=True)
+
+        condition = None
+        if targets is not None:
+            condition = self.__and(condition, ds.field("target").isin(list(targets)))
+        if start_date is not None:
+            condition = self.__and(condition, ds.field("date") >= self.__format_date(start_date))
+        if end_date is not None:
+            condition = self.__and(condition, ds.field("date") <= self.__format_date(end_date))
+        return dataset.to_table(columns=columns, filter=condition)
+
+    def read_pandas(self, kind: str, **kwargs):
+        return self.read(kind, **kwargs).to_pandas()
+
+    def __kind_root(self, kind: str) -> str:
+        return "/".join([self.root, kind])
+
+    def __check_kind(self, kind: str):
+        if kind not in self.KINDS:
+            raise ValueError(f"unknown score kind: {kind}")
+
+    @staticmethod
+    def __and(condition, other):
+        return other if condition is None else condition & other
+
+    @staticmethod
+    def __format_date(date: Union[date_type, str]) -> str:
+        if isinstance(date, str):
+            return date
+        return datetime.strftime(date, "%Y%m%d")
+
+    @staticmethod
+    def __dictionary_encode(table: pa.Table) -> pa.Table:
+        # パスなどの文字列は同じ値の繰り返しが多いので辞書エンコードする
+        for i, field in enumerate(table.schema):
+            if pa.types.is_string(field.type) or pa.types.is_large_string(field.type):
+                table = table.set_column(i, field.name, table.column(i).dictionary_encode())
+        return table
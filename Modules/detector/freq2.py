@@ -3,7 +3,9 @@ import math
 from scipy import stats
 from scipy.stats import gaussian_kde
 import dill
+import io
 import sys
+import struct
 import numpy as np
 import logging
 
@@ -253,3 +255,108 @@ class SaveData(object):
         freq_detector.inflate_model = self.inflate_model
         freq_detector.min_prob_dens = self.min_prob_dens
         freq_detector.normalize_score = self.normalize_score
+
+    def dumps(self, out_of_band: bool = False) -> bytes:
+        u"""
+            dill でシリアライズする。
+
+            Parameters
+            ----------
+                out_of_band : bool, default False
+                    True の場合、pickle プロトコル 5 の out-of-band バッファを使い、
+                    gaussian_kde の dataset や共分散行列などの大きな配列を pickle 本体と別の
+                    アラインしたブロックとして書き出す。
+                    ロードの際に配列をコピーせず、読み込んだバイト列やメモリマップを直接参照できる。
+        """
+        if not out_of_band:
+            return dill.dumps(self)
+
+        buffers = []
+        body = io.BytesIO()
+        _OutOfBandPickler(body, protocol=5, buffer_callback=buffers.append).dump(self)
+        raws = [buffer.raw() for buffer in buffers]
+
+        # ヘッダ | (オフセット, 長さ) の表 | pickle 本体 | バッファ ... の順に並べ、各バッファの先頭をアラインする
+        offset = OUT_OF_BAND_HEADER.size + OUT_OF_BAND_ENTRY.size * len(raws) + body.tell()
+        entries = []
+        for raw in raws:
+            offset = _align(offset)
+            entries.append((offset, raw.nbytes))
+            offset += raw.nbytes
+
+        out = bytearray(offset)
+        OUT_OF_BAND_HEADER.pack_into(out, 0, OUT_OF_BAND_MAGIC, len(raws), body.tell())
+        position = OUT_OF_BAND_HEADER.size
+        for entry in entries:
+            OUT_OF_BAND_ENTRY.pack_into(out, position, *entry)
+            position += OUT_OF_BAND_ENTRY.size
+        out[position:position + body.tell()] = body.getbuffer()
+        for raw, (offset, length) in zip(raws, entries):
+            out[offset:offset + length] = raw
+        return bytes(out)
+
+    @staticmethod
+    def is_out_of_band(data) -> bool:
+        return bytes(data[:len(OUT_OF_BAND_MAGIC)]) == OUT_OF_BAND_MAGIC
+
+    @staticmethod
+    def loads(data) -> "SaveData":
+        u"""
+            dumps で書き出したバイト列をロードする。従来の dill.dump の形式もそのまま読める。
+
+            Parameters
+            ----------
+                data : bytes-like
+                    bytes, bytearray, mmap など。out-of-band 形式で data が書き込み可能な場合
+                    (bytearray や ACCESS_COPY の mmap)、配列は data をコピーせずに参照するので、
+                    返り値を使っている間 data を閉じないこと。
+                    gaussian_kde の評価は書き込み可能な配列を要求するため、bytes のように
+                    読み取り専用の場合は一度だけ全体をコピーする。
+        """
+        if not SaveData.is_out_of_band(data):
+            return dill.loads(data)
+
+        view = memoryview(data)
+        if view.readonly:
+            view = memoryview(bytearray(view))
+        _, buffer_count, body_length = OUT_OF_BAND_HEADER.unpack_from(view, 0)
+        position = OUT_OF_BAND_HEADER.size
+        buffers = []
+        for _ in range(buffer_count):
+            offset, length = OUT_OF_BAND_ENTRY.unpack_from(view, position)
+            buffers.append(view[offset:offset + length])
+            position += OUT_OF_BAND_ENTRY.size
+        return dill.loads(view[position:position + body_length], buffers=buffers)
+
+
+# out-of-band 形式のヘッダ(マジック, バッファ数, pickle 本体の長さ)と、バッファごとの(オフセット, 長さ)
+OUT_OF_BAND_MAGIC = b"FRQOOB01"
+OUT_OF_BAND_HEADER = struct.Struct(">8sIQ")
+OUT_OF_BAND_ENTRY = struct.Struct(">QQ")
+# バッファの先頭のアラインメント。メモリマップからロードする場合はそのまま配列のアラインメントになる
+OUT_OF_BAND_ALIGNMENT = 64
+# これより小さい配列は pickle 本体に含める
+OUT_OF_BAND_MIN_BYTES = 1024
+
+
+def _align(offset: int) -> int:
+    return (offset + OUT_OF_BAND_ALIGNMENT - 1) // OUT_OF_BAND_ALIGNMENT * OUT_OF_BAND_ALIGNMENT
+
+
+class _OutOfBandPickler(dill.Pickler):
+    u"""
+        dill は ndarray を __reduce__ で常に pickle 本体に書き込むため、
+        大きな連続した配列だけ __reduce_ex__(5) を使い、PickleBuffer として buffer_callback に渡す。
+    """
+
+    def save(self, obj, save_persistent_id=True):
+        if (
+            type(obj) is np.ndarray
+            and id(obj) not in self.memo
+            and obj.nbytes >= OUT_OF_BAND_MIN_BYTES
+            and not obj.dtype.hasobject
+            and (obj.flags.c_contiguous or obj.flags.f_contiguous)
+        ):
+            self.save_reduce(*obj.__reduce_ex__(self.proto), obj=obj)
+            return
+        super(_OutOfBandPickler, self).save(obj, save_persistent_id)
@@ -1,6 +1,32 @@
 import sqlite3
 import os
+import hashlib
+import functools
 import sys
+import pathlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List
+
+# SQLiteのCOLLATE NOCASEはASCII文字のみ大文字小文字を同一視する
+_NOCASE_TABLE = str.maketrans(
+    "ABCDEFGHIJKLMNOPQRSTUVWXYZ", "abcdefghijklmnopqrstuvwxyz")
+
+
+def _nocase_key(name: str) -> str:
+    return name.translate(_NOCASE_TABLE)
+
+
+@functools.lru_cache(maxsize=None)
+def hash_target_name(target_name: str) -> str:
+    # Cloudではtarget_nameを小文字にしたもののsha1をfile_sys_nameとして扱う
+    return hashlib.sha1(target_name.lower().encode()).hexdigest()
+
+
+# 読み取り専用モードの接続プール(DBファイルの絶対パス -> 接続)
+# immutableで開いた接続は読み取りしか行わないため、ワーカースレッド間で1本の接続を共有する
+_read_only_connections: Dict[str, sqlite3.Connection] = {}
+_read_only_lock = threading.Lock()
 
 
 class Target(object):
@@ -12,11 +38,38 @@ class Target(object):
 
 class FileSystemNameDb(object):
 
-    def __init__(self, dbfile_path: str):
+    # IN句に渡すパラメータ数の上限(SQLITE_MAX_VARIABLE_NUMBERの古いデフォルト値999未満)
+    FIND_MANY_CHUNK_SIZE = 900
+
+    # 読み取り専用モードの接続設定
+    READ_ONLY_MMAP_SIZE = 268435456  # 256MB
+    READ_ONLY_PAGE_CACHE_KIB = 65536  # 64MB
+    READ_ONLY_CACHED_STATEMENTS = 256
+
+    def __init__(self, dbfile_path: str, cache_size: int = 0, read_only: bool = False):
+        u"""
+            Parameters
+            ----------
+                dbfile_path: str
+                    DBファイルのパス
+                cache_size: int, default 0
+                    find系メソッドの結果をプロセス内に保持するLRUキャッシュの件数。
+                    0の場合はキャッシュしない。
+                read_only: bool, default False
+                    Trueの場合、DBファイルを読み取り専用(mode=ro, immutable)で開き、
+                    mmapとページキャッシュを有効にした接続をプロセス内で共有する。
+                    本番環境ではDBは読み取りのみなので、並列のスコア算出ワーカーからはこちらを使う。
+                    DBファイルが存在しない場合も作成しない。
+        """
 
         self.db_path = dbfile_path
+        self.cache_size = cache_size
+        self.read_only = read_only
+        self.__name_cache = OrderedDict()
+        self.__file_sys_name_cache = OrderedDict()
+        self.__cache_lock = threading.Lock()
 
-        if os.path.exists(self.db_path):
+        if self.read_only or os.path.exists(self.db_path):
             return
         with sqlite3.connect(self.db_path) as conn:
             # 本番環境ではここでDBファイルを作成することはないはず
@@ -31,11 +84,47 @@ class FileSystemNameDb(object):
             conn.commit()
 
     def __enter__(self):
-        self.conn = sqlite3.connect(self.db_path)
+        if self.read_only:
+            self.conn = self.__get_read_only_connection()
+        else:
+            self.conn = sqlite3.connect(self.db_path)
         return self
 
     def __exit__(self, ex_type, ex_value, trace):
-        self.conn.close()
+        # 読み取り専用の接続はプールで使いまわすので閉じない
+        if not self.read_only:
+            self.conn.close()
+
+    def __get_read_only_connection(self) -> sqlite3.Connection:
+        path = pathlib.Path(self.db_path).resolve()
+        key = str(path)
+        with _read_only_lock:
+            conn = _read_only_connections.get(key)
+            if conn is not None:
+                return conn
+
+            # 接続を使いまわすため、sqlite3のステートメントキャッシュによってプリペアドステートメントも再利用される
+            conn = sqlite3.connect(
+                f"{path.as_uri()}?mode=ro&immutable=1",
+                uri=True,
+                check_same_thread=False,
+                cached_statements=self.READ_ONLY_CACHED_STATEMENTS)
+            conn.execute(f"PRAGMA mmap_size = {int(self.READ_ONLY_MMAP_SIZE)}")
+            # 負の値はKiB単位の指定になる
+            conn.execute(f"PRAGMA cache_size = {-int(self.READ_ONLY_PAGE_CACHE_KIB)}")
+            conn.execute("PRAGMA query_only = ON")
+            _read_only_connections[key] = conn
+            return conn
+
+    @staticmethod
+    def close_read_only_connections():
+        u"""
+            読み取り専用モードでプールしている接続をすべて閉じる。
+        """
+        with _read_only_lock:
+            for conn in _read_only_connections.values():
+                conn.close()
+            _read_only_connections.clear()
 
     def commit(self):
         self.conn.commit()
@@ -45,18 +134,88 @@ class FileSystemNameDb(object):
         cursor = self.conn.cursor()
         cursor.execute('INSERT OR REPLACE INTO T_FILE_SYSTEM_NAME (OriginalName,Name) VALUES (?,?)',
                        (target.name, target.file_sys_name))
+        self.clear_cache()
+
+    def store_many(self, targets: Iterable[Target]):
+        u"""
+            複数のTargetを1トランザクションでまとめて格納し、コミットする。
+            DBの作成や再構築時に用いる。
+
+            Note
+            ----
+                格納中のインデックス更新を避けるため、fsnameindexを一度削除し、
+                格納後に作り直している。
+                store などでトランザクションがすでに開いている場合は、その中のセーブポイントとして格納し、
+                コミットは呼び出し側の commit に任せる。失敗した場合は、このメソッドで行った変更だけを取り消す。
+        """
+        cursor = self.conn.cursor()
+        cursor.execute('SAVEPOINT store_many')
+        try:
+            cursor.execute('DROP INDEX IF EXISTS fsnameindex')
+            cursor.executemany(
+                'INSERT OR REPLACE INTO T_FILE_SYSTEM_NAME (OriginalName,Name) VALUES (?,?)',
+                ((target.name, target.file_sys_name) for target in targets))
+            cursor.execute(
+                'CREATE INDEX fsnameindex ON T_FILE_SYSTEM_NAME(Name)')
+            # トランザクションの外で始めたセーブポイントの場合は、RELEASEでコミットされる
+            cursor.execute('RELEASE store_many')
+        except Exception:
+            cursor.execute('ROLLBACK TO store_many')
+            cursor.execute('RELEASE store_many')
+            raise
+        finally:
+            self.clear_cache()
+
+    def export_name_map(self) -> Dict[str, str]:
+        u"""
+            Returns
+            -------
+                対象名 -> ファイルシステム上の名前 の辞書: dict of str
+
+            Note
+            ----
+                ワーカーの起動時に対応表全体をメモリに載せるために用いる。
+                キーは格納されている対象名そのままなので、大文字小文字を区別せずに引く場合は
+                呼び出し側で正規化すること。
+        """
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT OriginalName, Name FROM T_FILE_SYSTEM_NAME')
+        return dict(cursor.fetchall())
+
+    def export_arrow_table(self):
+        u"""
+            Returns
+            -------
+                OriginalName, Name の2カラムを持つ pyarrow.Table
+        """
+        import pyarrow as pa
+
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT OriginalName, Name FROM T_FILE_SYSTEM_NAME')
+        rows = cursor.fetchall()
+        names = [row[0] for row in rows]
+        file_sys_names = [row[1] for row in rows]
+        return pa.table({
+            "OriginalName": pa.array(names, type=pa.string()),
+            "Name": pa.array(file_sys_names, type=pa.string()),
+        })
+
+    def clear_cache(self):
+        with self.__cache_lock:
+            self.__name_cache.clear()
+            self.__file_sys_name_cache.clear()
 
     def contains_file_sys_name(self, file_sys_name: str) -> bool:
         cursor = self.conn.cursor()
         cursor.execute(
-            'SELECT * FROM T_FILE_SYSTEM_NAME WHERE Name COLLATE NOCASE = ?', (file_sys_name,))
-        return len(cursor.fetchall()) > 0
+            'SELECT 1 FROM T_FILE_SYSTEM_NAME WHERE Name COLLATE NOCASE = ? LIMIT 1', (file_sys_name,))
+        return cursor.fetchone() is not None
 
     def contains(self, target_name: str) -> bool:
         cursor = self.conn.cursor()
         cursor.execute(
-            'SELECT * FROM T_FILE_SYSTEM_NAME WHERE OriginalName COLLATE NOCASE = ?', (target_name,))
-        return len(cursor.fetchall()) > 0
+            'SELECT 1 FROM T_FILE_SYSTEM_NAME WHERE OriginalName COLLATE NOCASE = ? LIMIT 1', (target_name,))
+        return cursor.fetchone() is not None
 
     def find_all(self):
         cursor = self.conn.cursor()
@@ -83,14 +242,20 @@ class FileSystemNameDb(object):
                 CSVファイルの作成時点で必要となる対象名が必ず登録されているため、上記のような
                 空文字のインスタンスが返ることはない。
         """
-        if not self.contains(target_name):
-            return Target(target_name, "")
+        target = self.__get_cache(self.__name_cache, target_name)
+        if target is not None:
+            return target
 
         cursor = self.conn.cursor()
         cursor.execute(
             'SELECT * FROM T_FILE_SYSTEM_NAME WHERE OriginalName COLLATE NOCASE = ?', (target_name,))
         target_raw = cursor.fetchone()
-        return Target(target_raw[0], target_raw[1])
+        if target_raw is None:
+            return Target(target_name, "")
+
+        target = Target(target_raw[0], target_raw[1])
+        self.__put_cache(target)
+        return target
 
     def find_with_file_sys_name(self, file_sys_name: str) -> Target:
         u"""
@@ -98,14 +263,90 @@ class FileSystemNameDb(object):
             ----
                 返り値に関する注意はfindメソッドを参照。
         """
-        if not self.contains_file_sys_name(file_sys_name):
-            return Target("", file_sys_name)
+        target = self.__get_cache(self.__file_sys_name_cache, file_sys_name)
+        if target is not None:
+            return target
 
         cursor = self.conn.cursor()
         cursor.execute(
             'SELECT * FROM T_FILE_SYSTEM_NAME WHERE Name COLLATE NOCASE = ?', (file_sys_name,))
         target_raw = cursor.fetchone()
-        return Target(target_raw[0], target_raw[1])
+        if target_raw is None:
+            return Target("", file_sys_name)
+
+        target = Target(target_raw[0], target_raw[1])
+        self.__put_cache(target)
+        return target
+
+    def find_many(self, target_names: Iterable[str]) -> List[Target]:
+        u"""
+            複数の対象名をまとめて検索する。
+
+            Parameters
+            ----------
+                target_names: iterable of str
+                    対象名のリスト
+
+            Returns
+            -------
+                targets: list of Target
+                    target_namesと同じ順序のTargetのリスト
+
+            Note
+            ----
+                DBに格納されていない対象名については、findメソッドと同様に
+                ファイルシステム上の名前を空文字としたTargetを返す。
+                キャッシュにない対象名のみを、IN句で一括して問い合わせる。
+        """
+        target_names = list(target_names)
+        found: Dict[str, Target] = {}
+        missing = []
+        for target_name in target_names:
+            key = _nocase_key(target_name)
+            if key in found:
+                continue
+            target = self.__get_cache(self.__name_cache, target_name)
+            if target is not None:
+                found[key] = target
+            else:
+                missing.append(target_name)
+
+        cursor = self.conn.cursor()
+        for i in range(0, len(missing), self.FIND_MANY_CHUNK_SIZE):
+            chunk = missing[i:i + self.FIND_MANY_CHUNK_SIZE]
+            placeholders = ",".join("?" * len(chunk))
+            cursor.execute(
+                f'SELECT * FROM T_FILE_SYSTEM_NAME WHERE OriginalName COLLATE NOCASE IN ({placeholders})', chunk)
+            for target_raw in cursor.fetchall():
+                target = Target(target_raw[0], target_raw[1])
+                found[_nocase_key(target.name)] = target
+                self.__put_cache(target)
+
+        return [
+            found.get(_nocase_key(target_name)) or Target(target_name, "")
+            for target_name in target_names
+        ]
+
+    def __get_cache(self, cache: OrderedDict, name: str) -> Target:
+        if self.cache_size <= 0:
+            return None
+        key = _nocase_key(name)
+        with self.__cache_lock:
+            target = cache.get(key)
+            if target is not None:
+                cache.move_to_end(key)
+        return target
+
+    def __put_cache(self, target: Target):
+        if self.cache_size <= 0:
+            return
+        with self.__cache_lock:
+            for cache, name in ((self.__name_cache, target.name),
+                                (self.__file_sys_name_cache, target.file_sys_name)):
+                cache[_nocase_key(name)] = target
+                cache.move_to_end(_nocase_key(name))
+                while len(cache) > self.cache_size:
+                    cache.popitem(last=False)
 
 
 if __name__ == "__main__":
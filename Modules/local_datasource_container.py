@@ -0,0 +1,272 @@
+import os
+import glob
+import json
+import mmap
+from datetime import datetime
+from typing import Dict, List, Tuple
+from Modules.detector.freq2 import FrequencyDetector, SaveData
+from Modules.datasource_container import IDataSourceContainer
+from Modules.file_system_name_db import hash_target_name
+from Modules.local_model_db import LocalModelDb
+from Modules.util.atomic_file import atomic_write
+import score_db as scoredb
+import dill
+
+
+def _mmap_load(path: str):
+    u"""
+        ファイルをメモリマップしてdillでロードする。
+        ファイル全体を一度に読み込んでコピーすることはなく、ページキャッシュから直接読む。
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return dill.load(f)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return dill.load(mm)
+
+
+def _mmap_load_savedata(path: str) -> SaveData:
+    u"""
+        頻度モデルをロードする。out-of-band 形式の場合、配列はメモリマップを直接参照する。
+        gaussian_kde は書き込み可能な配列を要求するので、コピーオンライトでマップする。
+        マップは配列が参照しなくなった時点で解放される。
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return dill.load(f)
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    if SaveData.is_out_of_band(mm):
+        return SaveData.loads(mm)
+    with mm:
+        return dill.load(mm)
+
+
+class LocalDataSourceContainer(IDataSourceContainer):
+    u"""
+        ローカルのファイルシステムを使うデータアクセス。
+        root_dir をバケットに見立て、AwsDataSourceContainer と同じキー配置
+        ({base_system_key}/reportModels/{model_id}/{fsname}/pathdetector など)でファイルを置く。
+        オンプレ環境での実行や、S3を介さないベンチマークの基準として用いる。
+
+        モデルはメモリマップしたファイルから読み込み、書き込みはすべて一時ファイルからのリネームで行う。
+        59048修正前の古いモデル名での読み込みには対応していない。
+    """
+
+    def __init__(
+        self,
+        root_dir: str,
+        base_system_key: str,
+        base_data_key: str,
+        report_id,
+        target_name: str,
+        path_temp_score_db_key=None,
+        freq_temp_score_db_key=None,
+        out_of_band_models: bool = False,
+        model_db=None
+    ):
+        u"""
+            Parameters
+            ----------
+                root_dir : str
+                    S3のバケットに相当するディレクトリ
+                out_of_band_models : bool, default False
+                    True の場合、頻度モデルを pickle プロトコル 5 の out-of-band 形式で保存する。
+                    ロード時は配列をコピーせず、メモリマップしたファイルを直接参照する。
+                model_db : optional
+                    モデル情報の管理に使うオブジェクト(AwsModelDb と同じインターフェース)。
+                    省略した場合は root_dir 下のSQLiteファイルで管理する LocalModelDb を使う。
+                その他 :
+                    AwsDataSourceContainer と同じ
+        """
+        self.root_dir = root_dir
+        self.base_system_key = base_system_key
+        self.base_data_key = base_data_key
+        self.report_id = report_id
+        self.target_name = target_name
+        self.path_temp_score_db_key = path_temp_score_db_key
+        self.freq_temp_score_db_key = freq_temp_score_db_key
+        self.out_of_band_models = out_of_band_models
+        self.__model_db = model_db
+
+    def __enter__(self):
+        self.score_db = scoredb.AwsScoreDb(
+            os.path.join(self.root_dir, ".work", "ALog", self.get_file_sys_name()))
+        return self
+
+    def __exit__(self, ex_type, ex_value, trace):
+        # AwsDataSourceContainer がS3へアップロードするのと同じキーに配置する
+        if not os.path.isdir(self.score_db.output_dir):
+            return
+        for kind, key_base in (("path", self.path_temp_score_db_key), ("freq", self.freq_temp_score_db_key)):
+            kind_dir = os.path.join(self.score_db.output_dir, kind)
+            if key_base is None or not os.path.isdir(kind_dir):
+                continue
+            for file in os.listdir(kind_dir):
+                date = file.rstrip(".csv")
+                with open(os.path.join(kind_dir, file), "rb") as f:
+                    atomic_write(
+                        self.__local_path("/".join([key_base, date, f"{self.get_file_sys_name()}.csv"])),
+                        f.read())
+
+    def __local_path(self, key: str) -> str:
+        return os.path.join(self.root_dir, *key.split("/"))
+
+    def _get_model_db(self):
+        if self.__model_db is None:
+            self.__model_db = LocalModelDb(os.path.join(self.root_dir, ".work", "modeldb.sqlite3"))
+        return self.__model_db
+
+    def save_model_data(self, status):
+        # ローカルではモデル情報を管理する場所が他にないので、ここで保存する
+        self._get_model_db().update_report_model(status)
+
+    def save_fpd_file(self, fpd_detector, model_id, fsname):
+        path = self.get_target_model_path(model_id, self.get_file_sys_name())
+        atomic_write(self.__local_path(path), dill.dumps(fpd_detector))
+
+    def load_fpd_file(self, model_id, fsname):
+        path = self.get_target_model_path(model_id, self.get_file_sys_name())
+        try:
+            return _mmap_load(self.__local_path(path))
+        except OSError:
+            return None
+
+    def save_topic_model_file(self, model_id, lda, filename):
+        # ここでは実装しない
+        return
+
+    def save_target_layout_file(self, word_layout, model_id, fsname):
+        # ここでは実装しない
+        return
+
+    def save_freq_model_file(self, model_id, fsname, hour, detector):
+        path = self.__get_usermodel_filepath(model_id, self.get_file_sys_name(), hour)
+        atomic_write(
+            self.__local_path(path), SaveData(detector).dumps(out_of_band=self.out_of_band_models))
+
+    def load_freq_model_file(
+        self,
+        model_id,
+        fsname: str,
+        min_prob_dens
+    ) -> Dict[int, FrequencyDetector]:
+        detectors = {}
+        for hour in range(0, 24):
+            path = self.__get_usermodel_filepath(model_id, self.get_file_sys_name(), hour)
+            try:
+                savedata = _mmap_load_savedata(self.__local_path(path))
+            except OSError:
+                return
+            detector = FrequencyDetector(
+                min_prob_dens=min_prob_dens
+            )
+            savedata.set_params(detector)
+            detectors[hour] = detector
+        return detectors
+
+    def load_fbmodel_file(self, report_id, fsname):
+        path = self.__get_fbmodel_filepath(report_id, self.get_file_sys_name())
+        try:
+            return _mmap_load(self.__local_path(path))
+        except OSError:
+            return None
+
+    def save_model_contour(self, model_id, target_name, date, contour_data):
+        path = self.__get_freq_contour_filepath(model_id, self.get_file_sys_name(), date)
+        atomic_write(self.__local_path(path), json.dumps(contour_data).encode())
+
+    def save_path_score(self, path_score_summary):
+        self.score_db.store_path_score(path_score_summary)
+
+    def save_freq_score(self, freq_score_summary):
+        self.score_db.store_freqscore(freq_score_summary)
+
+    def get_freq_score(self, fsname, date):
+        filename = datetime.strftime(date, "%Y%m%d") + ".csv"
+        filepath = os.path.join(self.score_db.output_dir, "freq", filename)
+        return self.score_db.get_freqscore_from_local(filepath, self.target_name, date, self.report_id)
+
+    def delete_path_score(self, reportid):
+        return
+
+    def delete_freq_score(self, reportid):
+        return
+
+    def delete_old_pathscore(self, detected_date, current_time, report_id):
+        return
+
+    def delete_old_freqscore(self, detected_date, current_time, report_id):
+        return
+
+    def collect_target_fsname_and_csv_file_paths(
+        self,
+        report_id
+    ) -> List[Tuple[str, List[str]]]:
+        u"""
+            学習データのディレクトリのファイル群を、スコア算出対象毎に仕分けて返す
+
+            Returns
+            -------
+                list of tuple(file_sys_name: str, csv_file_paths: list of str)
+        """
+        dir_path = self.get_target_csv_file_dir_path(report_id)
+        if not os.path.isdir(dir_path):
+            return []
+        return [
+            (
+                file_sys_name,
+                # note: globでは角括弧[]をエスケープしないといけない
+                glob.glob(os.path.join(glob.escape(dir_path), glob.escape(file_sys_name), '*.csv'))
+            )
+            for file_sys_name in os.listdir(dir_path)
+        ]
+
+    def get_target_csv_file_dir_path(self, report_id) -> str:
+        # ローカルでは学習データをダウンロードせず、その場所を直接読む
+        return self.__local_path(self.base_data_key)
+
+    def set_dataset(
+        self,
+        logger,
+        max_workers: int = None,
+        max_bytes: int = None
+    ):
+        # 学習データはすでにローカルにあるので何もしない
+        # 引数は AwsDataSourceContainer と呼び出し方を揃えるためのもの
+        return
+
+    def get_target_model_dir_path(self, model_id: str, fsname: str) -> str:
+        return "/".join([self.base_system_key.rstrip('/'), "reportModels", model_id, fsname])
+
+    def get_target_model_path(self, model_id: str, fsname: str) -> str:
+        return "/".join([self.get_target_model_dir_path(model_id, fsname), "pathdetector"])
+
+    def get_models_dir_path(self, model_id) -> str:
+        return "/".join([self.base_system_key.rstrip('/'), "reportModels", model_id])
+
+    def __get_fbmodel_filepath(self, report_id, fsname):
+        return "/".join([self.base_system_key.rstrip('/'), "feedbackModel", str(report_id), fsname, "feedbackmodel"])
+
+    def __get_freq_contour_filepath(self, model_id, fsname, date):
+        str_date = datetime.strftime(date, "%Y%m%d")
+        return "/".join([self.get_target_model_dir_path(model_id, fsname), "freqContour", f"{str_date}.json"])
+
+    def __get_usermodel_filepath(self, model_id, fsname, hour) -> str:
+        return "/".join([self.get_target_model_dir_path(model_id, fsname), str(hour)])
+
+    def get_reportmodel(self, report_id: int, risk_kind: int):
+        return self._get_model_db().get_cur_report_model(report_id, risk_kind)
+
+    def get_file_sys_name(self, target_name=None):
+        if target_name == None:
+            return hash_target_name(self.target_name)
+        else:
+            return hash_target_name(target_name)
+
+    def get_target_name(self, file_sys_name=None):
+        return self.target_name
+
+    def check_fpd_file(self, model_id, fsname):
+        dir_path = self.__local_path(
+            self.get_target_model_dir_path(model_id, self.get_file_sys_name()))
+        return os.path.isdir(dir_path) and len(os.listdir(dir_path)) > 0
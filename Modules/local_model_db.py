@@ -0,0 +1,59 @@
+import os
+import sqlite3
+import dill
+
+
+class LocalModelDb(object):
+    u"""
+        AwsModelDb の代わりに、レポートのモデル情報をローカルのSQLiteファイルで管理する。
+        get_cur_report_model / update_report_model は AwsModelDb と同じ呼び出し方で使える。
+        モデル情報のオブジェクト(ReportModelStatus)はdillでシリアライズして保存する。
+    """
+
+    def __init__(self, dbfile_path: str):
+        u"""
+            Parameters
+            ----------
+                dbfile_path: str
+                    DBファイルのパス。存在しない場合は作成する
+        """
+        self.db_path = dbfile_path
+        if os.path.exists(self.db_path):
+            return
+        dir_path = os.path.dirname(self.db_path)
+        if dir_path:
+            os.makedirs(dir_path, exist_ok=True)
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute(
+                '''CREATE TABLE IF NOT EXISTS T_REPORT_MODEL
+                    (ReportId integer NOT NULL, RiskKind integer NOT NULL, Status blob NOT NULL,
+                    PRIMARY KEY(ReportId, RiskKind))''')
+            conn.commit()
+
+    def get_cur_report_model(self, report_id: int, risk_kind: int):
+        u"""
+            Returns
+            -------
+                保存されているモデル情報。登録されていない場合は None
+        """
+        with sqlite3.connect(self.db_path) as conn:
+            row = conn.execute(
+                'SELECT Status FROM T_REPORT_MODEL WHERE ReportId = ? AND RiskKind = ?',
+                (int(report_id), int(risk_kind))).fetchone()
+        if row is None:
+            return None
+        return dill.loads(row[0])
+
+    def update_report_model(self, status):
+        u"""
+            モデル情報を登録する。同じレポート・リスク種別のものがあれば置き換える。
+            status は AwsModelDb と同様に report_id と risk_kind 属性を持つこと。
+        """
+        self.set_report_model(status.report_id, status.risk_kind, status)
+
+    def set_report_model(self, report_id: int, risk_kind: int, status):
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO T_REPORT_MODEL (ReportId, RiskKind, Status) VALUES (?, ?, ?)',
+                (int(report_id), int(risk_kind), dill.dumps(status)))
+            conn.commit()
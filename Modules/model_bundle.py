@@ -0,0 +1,344 @@
+"""
+対象ごとのモデル(pathdetector, 24時間分の頻度モデル, freqContour, feedbackmodel)を
+1つのS3オブジェクトにまとめるバンドル形式。
+
+| MAGIC (8 byte) | ヘッダ長 (>I, 4 byte) | ヘッダ(JSON) | 各モデルの本体 ... |
+
+ヘッダは {"entries": {名前: [オフセット, 長さ]}, "sources": {名前: [従来のキー, ETag]}} で、
+オフセットは本体部分の先頭からの位置。
+名前は従来のキーの対象フォルダからの相対パス("pathdetector", "0"～"23", "freqContour/20180601.json")と、
+フィードバックモデル用の "feedbackmodel"。
+ヘッダだけを範囲GETで読めば、任意のモデルを1回の範囲GETで取得できる。
+
+バンドルは従来のキーのコピーで、再学習などで従来のキーが更新されてもバンドルは更新されない。
+sources に作成時の各モデルの ETag を記録しておき、読み込み側は is_bundle_current で
+従来のキーと一致するかを確かめる。一致しない(古い)バンドルは使わずに従来のキーから読み込み、
+migrate_model を実行し直してバンドルを作り直すこと。sources のない古い形式のバンドルは常に古いものとして扱う。
+"""
+
+import sys
+import json
+import struct
+import argparse
+import logging
+from typing import Dict, List, Tuple
+import boto3
+from botocore.exceptions import ClientError
+
+
+MAGIC = b"MDLBNDL1"
+PREFIX_FORMAT = ">8sI"
+PREFIX_SIZE = struct.calcsize(PREFIX_FORMAT)
+FBMODEL_ENTRY = "feedbackmodel"
+
+
+def build_bundle(entries: Dict[str, bytes], sources: Dict[str, List[str]] = None) -> bytes:
+    u"""
+        Parameters
+        ----------
+            entries : dict of (名前: str, 本体: bytes)
+            sources : dict of (名前: str, [従来のキー, ETag]), optional
+                collect_target_entries で得られる、各モデルの作成元
+
+        Returns
+        -------
+            バンドルのバイト列
+    """
+    index = {}
+    offset = 0
+    for name, data in entries.items():
+        index[name] = [offset, len(data)]
+        offset += len(data)
+    header = json.dumps(
+        {"entries": index, "sources": sources or {}}, separators=(",", ":")).encode("utf-8")
+
+    bundle = bytearray(struct.pack(PREFIX_FORMAT, MAGIC, len(header)))
+    bundle.extend(header)
+    for data in entries.values():
+        bundle.extend(data)
+    return bytes(bundle)
+
+
+def parse_header(data: bytes) -> Tuple[Dict[str, List[int]], int]:
+    u"""
+        Returns
+        -------
+            (名前 -> [オフセット, 長さ] の辞書, 本体部分の先頭位置)
+
+        Raises
+        ------
+            ValueError : バンドル形式ではない場合、もしくはヘッダが途中で切れている場合
+    """
+    header, body_start = _parse_header_json(data)
+    return header["entries"], body_start
+
+
+def parse_sources(data: bytes) -> Dict[str, List[str]]:
+    u"""
+        Returns
+        -------
+            名前 -> [従来のキー, ETag] の辞書。古い形式のバンドルでは None
+    """
+    header, _ = _parse_header_json(data)
+    return header.get("sources")
+
+
+def _parse_header_json(data: bytes) -> Tuple[dict, int]:
+    if len(data) < PREFIX_SIZE:
+        raise ValueError("bundle header is truncated")
+    magic, header_size = struct.unpack_from(PREFIX_FORMAT, data)
+    if magic != MAGIC:
+        raise ValueError("not a model bundle")
+    body_start = PREFIX_SIZE + header_size
+    if len(data) < body_start:
+        raise ValueError("bundle header is truncated")
+    header = json.loads(bytes(data[PREFIX_SIZE:body_start]).decode("utf-8"))
+    return header, body_start
+
+
+def parse_bundle(data: bytes) -> Dict[str, memoryview]:
+    u"""
+        バンドル全体から各モデルの本体を取り出す。本体はコピーせず memoryview で返す。
+    """
+    entries, body_start = parse_header(data)
+    view = memoryview(data)
+    return {
+        name: view[body_start + offset:body_start + offset + length]
+        for name, (offset, length) in entries.items()
+    }
+
+
+class ModelBundleReader(object):
+    u"""
+        S3上のバンドルを読むためのクラス。
+        read はヘッダと対象のモデルをそれぞれ範囲GETで取得し、read_all はバンドル全体を1回のGETで取得する。
+    """
+
+    # 最初の範囲GETで読む大きさ。ヘッダがこれより大きい場合は残りを追加で読む
+    HEADER_PREFETCH_SIZE = 65536
+
+    def __init__(self, s3_client, bucket_name: str, key: str):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.__entries = None
+        self.__sources = None
+        self.__body_start = None
+
+    def __get_range(self, start: int, end: int) -> bytes:
+        # endは範囲に含まれる
+        response = self.s3_client.get_object(
+            Bucket=self.bucket_name, Key=self.key, Range=f"bytes={start}-{end}")
+        return response["Body"].read()
+
+    def read_index(self) -> Dict[str, List[int]]:
+        if self.__entries is None:
+            head = self.__get_range(0, self.HEADER_PREFETCH_SIZE - 1)
+            _, header_size = struct.unpack_from(PREFIX_FORMAT, head)
+            if len(head) < PREFIX_SIZE + header_size:
+                head += self.__get_range(len(head), PREFIX_SIZE + header_size - 1)
+            self.__entries, self.__body_start = parse_header(head)
+            self.__sources = parse_sources(head)
+        return self.__entries
+
+    def sources(self) -> Dict[str, List[str]]:
+        u"""
+            作成時の各モデルの [従来のキー, ETag]。read_index もしくは read_all の後に呼ぶこと
+        """
+        return self.__sources
+
+    def names(self) -> List[str]:
+        return list(self.read_index().keys())
+
+    def read(self, name: str) -> bytes:
+        u"""
+            Raises
+            ------
+                KeyError : バンドルに含まれないモデル名の場合
+        """
+        offset, length = self.read_index()[name]
+        if length == 0:
+            return b""
+        start = self.__body_start + offset
+        return self.__get_range(start, start + length - 1)
+
+    def read_all(self) -> Dict[str, memoryview]:
+        response = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.key)
+        data = response["Body"].read()
+        self.__sources = parse_sources(data)
+        return parse_bundle(data)
+
+
+def get_bundle_key(target_model_dir_path: str) -> str:
+    u"""
+        バンドルのキー。従来の対象フォルダ({...}/reportModels/{model_id}/{fsname})と同じ階層に置く。
+        対象フォルダの外に置くことで、check_fpd_file などのプレフィックス検索に影響を与えない。
+    """
+    return target_model_dir_path.rstrip("/") + ".bundle"
+
+
+def _strip_etag(etag: str) -> str:
+    return etag.strip('"')
+
+
+def collect_target_entries(
+    s3_client,
+    bucket_name: str,
+    target_model_dir_path: str,
+    fbmodel_path: str = None,
+    sources: Dict[str, List[str]] = None
+) -> Dict[str, bytes]:
+    u"""
+        従来のキー配置から、1対象分のモデルを集める。
+
+        Parameters
+        ----------
+            sources : dict, optional
+                指定した場合、各モデルの [従来のキー, ETag] をこの辞書に格納する(build_bundle に渡す)
+    """
+    if sources is None:
+        sources = {}
+    prefix = target_model_dir_path.rstrip("/") + "/"
+    entries = {}
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for content in page.get("Contents", []):
+            key = content["Key"]
+            if key[-1] == "/":
+                continue
+            response = s3_client.get_object(Bucket=bucket_name, Key=key)
+            entries[key[len(prefix):]] = response["Body"].read()
+            sources[key[len(prefix):]] = [key, _strip_etag(response["ETag"])]
+
+    if fbmodel_path is not None:
+        try:
+            response = s3_client.get_object(Bucket=bucket_name, Key=fbmodel_path)
+            entries[FBMODEL_ENTRY] = response["Body"].read()
+            sources[FBMODEL_ENTRY] = [fbmodel_path, _strip_etag(response["ETag"])]
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") not in ("NoSuchKey", "404"):
+                raise
+    return entries
+
+
+def is_bundle_current(
+    s3_client,
+    bucket_name: str,
+    target_model_dir_path: str,
+    sources: Dict[str, List[str]]
+) -> bool:
+    u"""
+        バンドルの作成後に従来のキーが更新・追加・削除されていないかを確かめる。
+        対象フォルダは1回のリスティング、フィードバックモデルは HEAD で確認する。
+        バンドル作成後に新しく作られたフィードバックモデルは検出できない(sources に含まれないため)。
+
+        Parameters
+        ----------
+            sources : ModelBundleReader.sources() の値。None の場合(古い形式)は常に False
+    """
+    if sources is None:
+        return False
+    prefix = target_model_dir_path.rstrip("/") + "/"
+    current = {}
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for content in page.get("Contents", []):
+            key = content["Key"]
+            if key[-1] != "/":
+                current[key[len(prefix):]] = _strip_etag(content["ETag"])
+
+    expected = {name: etag for name, (_, etag) in sources.items() if name != FBMODEL_ENTRY}
+    if current != expected:
+        return False
+
+    if FBMODEL_ENTRY in sources:
+        fbmodel_path, etag = sources[FBMODEL_ENTRY]
+        try:
+            response = s3_client.head_object(Bucket=bucket_name, Key=fbmodel_path)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                return False
+            raise
+        if _strip_etag(response["ETag"]) != etag:
+            return False
+    return True
+
+
+def migrate_model(
+    s3_client,
+    bucket_name: str,
+    base_system_key: str,
+    model_id: str,
+    report_id: str = None,
+    fsnames: List[str] = None,
+    dry_run: bool = False
+) -> List[str]:
+    u"""
+        reportModels/{model_id}/ 配下の各対象について、従来のキー配置からバンドルを作成して保存する。
+        従来のキーは削除しない。
+        バンドルは実行時点のスナップショットなので、再学習やフィードバックでモデルが更新された後は
+        古いバンドルとして読み込み側で使われなくなる。再度実行してバンドルを作り直すこと。
+
+        Parameters
+        ----------
+            report_id : str, optional
+                指定した場合、feedbackModel/{report_id}/{fsname}/feedbackmodel もバンドルに含める
+            fsnames : list of str, optional
+                移行する対象。指定しない場合は model_id 配下の全対象
+
+        Returns
+        -------
+            作成したバンドルのキーのリスト
+    """
+    base = base_system_key.rstrip("/")
+    models_prefix = "/".join([base, "reportModels", model_id]) + "/"
+    if fsnames is None:
+        fsnames = []
+        paginator = s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=models_prefix, Delimiter="/"):
+            fsnames.extend(
+                common_prefix["Prefix"].split("/")[-2]
+                for common_prefix in page.get("CommonPrefixes", []))
+
+    bundle_keys = []
+    for fsname in fsnames:
+        target_model_dir_path = models_prefix + fsname
+        fbmodel_path = None
+        if report_id is not None:
+            fbmodel_path = "/".join([base, "feedbackModel", str(report_id), fsname, "feedbackmodel"])
+        sources = {}
+        entries = collect_target_entries(
+            s3_client, bucket_name, target_model_dir_path, fbmodel_path, sources=sources)
+        if not entries:
+            continue
+        bundle_key = get_bundle_key(target_model_dir_path)
+        logging.info(f"migrate model bundle. [key: {bundle_key}][entries: {len(entries)}]")
+        if not dry_run:
+            s3_client.put_object(
+                Bucket=bucket_name, Key=bundle_key, Body=build_bundle(entries, sources))
+        bundle_keys.append(bundle_key)
+    return bundle_keys
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="従来のキー配置のモデルを、対象ごとのバンドルに変換する。"
+                    "モデルの更新後は再実行してバンドルを作り直すこと(古いバンドルは読み込み時に無視される)")
+    parser.add_argument("bucket")
+    parser.add_argument("base_system_key")
+    parser.add_argument("model_id")
+    parser.add_argument("--report-id")
+    parser.add_argument("--fsname", action="append", dest="fsnames")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    keys = migrate_model(
+        boto3.client("s3"),
+        args.bucket,
+        args.base_system_key,
+        args.model_id,
+        report_id=args.report_id,
+        fsnames=args.fsnames,
+        dry_run=args.dry_run)
+    print(f"{len(keys)} bundles", file=sys.stderr)
@@ -0,0 +1,252 @@
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Dict, Tuple
+from botocore.exceptions import ClientError
+
+
+class S3ObjectCache(object):
+    u"""
+        S3オブジェクトのリードスルーキャッシュ。
+        バケット名・キー・ETagをキーとして、メモリとローカルディスクの2段で保持する。
+
+        キャッシュ済みのオブジェクトを読む際は If-None-Match による条件付きGETを行い、
+        S3上のオブジェクトが更新されていない場合(304)はダウンロードせずにキャッシュを返す。
+        ディスク上のファイルは {cache_dir}/{sha256(bucket/key)}/{etag} に置かれ、
+        サイズの上限を超えた場合は最も古く使われたものから削除する。
+
+        Lambdaのインスタンスが使いまわされた場合にもキャッシュが残るよう、cache_dirは
+        AwsDataSourceContainer.__enter__ の一時ディレクトリ掃除の対象から除外される。
+    """
+
+    DIR_NAME = "s3_object_cache"
+    # ディスクキャッシュの上限(1GB)。学習データのダウンロードはこの分を差し引いた容量で行う
+    MAX_DISK_BYTES = 1073741824
+    # メモリキャッシュの上限(256MB)
+    MAX_MEMORY_BYTES = 268435456
+
+    def __init__(
+        self,
+        cache_dir: str = None,
+        max_disk_bytes: int = MAX_DISK_BYTES,
+        max_memory_bytes: int = MAX_MEMORY_BYTES,
+        max_age: float = 0
+    ):
+        u"""
+            Parameters
+            ----------
+                cache_dir : str, optional
+                    ディスクキャッシュの置き場所。デフォルトは {tempdir}/s3_object_cache
+                max_disk_bytes : int
+                    ディスクキャッシュの合計サイズの上限(byte)
+                max_memory_bytes : int
+                    メモリキャッシュの合計サイズの上限(byte)
+                max_age : float, default 0
+                    最後にS3と照合してからこの秒数以内であれば、条件付きGETも行わずにキャッシュを返す。
+                    0の場合は毎回照合する。
+        """
+        self.cache_dir = cache_dir or os.path.join(tempfile.gettempdir(), self.DIR_NAME)
+        self.max_disk_bytes = max_disk_bytes
+        self.max_memory_bytes = max_memory_bytes
+        self.max_age = max_age
+
+        # (bucket, key) -> (etag, size, 最後にS3と照合した時刻)。並び順がLRUの順序になる
+        self.__disk_index: OrderedDict = OrderedDict()
+        self.__memory: OrderedDict = OrderedDict()
+        self.__disk_bytes = 0
+        self.__memory_bytes = 0
+        self.__lock = threading.Lock()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.__load_disk_index()
+
+    @property
+    def disk_bytes(self) -> int:
+        return self.__disk_bytes
+
+    def get(self, s3_client, bucket: str, key: str) -> bytes:
+        u"""
+            オブジェクトの内容を返す。キャッシュにない、もしくはS3上で更新されていれば
+            ダウンロードしてキャッシュに格納する。
+            オブジェクトが存在しない場合は botocore の ClientError をそのまま送出する。
+        """
+        cache_key = (bucket, key)
+        with self.__lock:
+            entry = self.__disk_index.get(cache_key)
+
+        if entry is not None:
+            etag, _, validated_at = entry
+            if time.time() - validated_at < self.max_age:
+                data = self.__read_cached(cache_key, etag)
+                if data is not None:
+                    return data
+            try:
+                response = s3_client.get_object(Bucket=bucket, Key=key, IfNoneMatch=etag)
+            except ClientError as e:
+                if not self.__is_not_modified(e):
+                    raise
+                with self.__lock:
+                    if cache_key in self.__disk_index:
+                        self.__disk_index[cache_key] = (etag, entry[1], time.time())
+                data = self.__read_cached(cache_key, etag)
+                if data is not None:
+                    return data
+                response = s3_client.get_object(Bucket=bucket, Key=key)
+        else:
+            response = s3_client.get_object(Bucket=bucket, Key=key)
+
+        data = response["Body"].read()
+        with self.__lock:
+            self.misses += 1
+        self.__store(cache_key, response["ETag"].strip('"'), data)
+        return data
+
+    def stats(self) -> Dict[str, float]:
+        with self.__lock:
+            total = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.disk_hits) / total if total else 0.0,
+                "disk_bytes": self.__disk_bytes,
+                "memory_bytes": self.__memory_bytes,
+            }
+
+    def clear(self):
+        with self.__lock:
+            self.__disk_index.clear()
+            self.__memory.clear()
+            self.__disk_bytes = 0
+            self.__memory_bytes = 0
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    @staticmethod
+    def __is_not_modified(error: ClientError) -> bool:
+        status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+        code = error.response.get("Error", {}).get("Code")
+        return status == 304 or code in ("304", "NotModified")
+
+    def __object_dir(self, cache_key: Tuple[str, str]) -> str:
+        digest = hashlib.sha256("/".join(cache_key).encode()).hexdigest()
+        return os.path.join(self.cache_dir, digest)
+
+    def __read_cached(self, cache_key: Tuple[str, str], etag: str) -> bytes:
+        with self.__lock:
+            memory_entry = self.__memory.get(cache_key)
+            if memory_entry is not None and memory_entry[0] == etag:
+                self.__memory.move_to_end(cache_key)
+                self.__disk_index.move_to_end(cache_key)
+                self.memory_hits += 1
+                return memory_entry[1]
+
+        try:
+            with open(os.path.join(self.__object_dir(cache_key), etag), "rb") as f:
+                data = f.read()
+        except OSError:
+            # 一時ディレクトリごと削除された場合など
+            with self.__lock:
+                self.__forget(cache_key)
+            return None
+
+        with self.__lock:
+            if cache_key in self.__disk_index:
+                self.__disk_index.move_to_end(cache_key)
+            self.__put_memory(cache_key, etag, data)
+            self.disk_hits += 1
+        return data
+
+    def __store(self, cache_key: Tuple[str, str], etag: str, data: bytes):
+        if len(data) > self.max_disk_bytes:
+            return
+        object_dir = self.__object_dir(cache_key)
+        os.makedirs(object_dir, exist_ok=True)
+        # 書き込み途中のファイルを読まないよう、一時ファイルに書いてからリネームする
+        tmp_path = os.path.join(object_dir, f".{etag}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, os.path.join(object_dir, etag))
+
+        with self.__lock:
+            old_entry = self.__disk_index.get(cache_key)
+            if old_entry is not None:
+                self.__forget(cache_key, keep_etag=etag)
+            self.__disk_index[cache_key] = (etag, len(data), time.time())
+            self.__disk_bytes += len(data)
+            self.__put_memory(cache_key, etag, data)
+            while self.__disk_bytes > self.max_disk_bytes and len(self.__disk_index) > 1:
+                oldest_key = next(iter(self.__disk_index))
+                self.__forget(oldest_key)
+
+    def __put_memory(self, cache_key: Tuple[str, str], etag: str, data: bytes):
+        if len(data) > self.max_memory_bytes:
+            return
+        old = self.__memory.pop(cache_key, None)
+        if old is not None:
+            self.__memory_bytes -= len(old[1])
+        self.__memory[cache_key] = (etag, data)
+        self.__memory_bytes += len(data)
+        while self.__memory_bytes > self.max_memory_bytes:
+            _, (_, evicted) = self.__memory.popitem(last=False)
+            self.__memory_bytes -= len(evicted)
+
+    def __forget(self, cache_key: Tuple[str, str], keep_etag: str = None):
+        entry = self.__disk_index.pop(cache_key, None)
+        if entry is not None:
+            self.__disk_bytes -= entry[1]
+            if entry[0] != keep_etag:
+                try:
+                    os.remove(os.path.join(self.__object_dir(cache_key), entry[0]))
+                except OSError:
+                    pass
+        memory_entry = self.__memory.pop(cache_key, None)
+        if memory_entry is not None:
+            self.__memory_bytes -= len(memory_entry[1])
+
+    def __load_disk_index(self):
+        u"""
+            前回のプロセスが残したディスクキャッシュを読み込む。
+            対象のバケット名とキーはディレクトリ名から復元できないため、照合用にindexファイルを使う。
+        """
+        index_path = os.path.join(self.cache_dir, "index")
+        if not os.path.isfile(index_path):
+            return
+        entries = []
+        with open(index_path, "r", encoding="utf-8") as f:
+            for line in f:
+                parts = line.rstrip("\n").split("\t")
+                if len(parts) != 3:
+                    continue
+                bucket, key, etag = parts
+                path = os.path.join(self.__object_dir((bucket, key)), etag)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_atime, (bucket, key), etag, stat.st_size))
+        for _, cache_key, etag, size in sorted(entries):
+            # 照合時刻は不明なので0とし、最初の読み込みで必ず条件付きGETを行う
+            self.__disk_index[cache_key] = (etag, size, 0)
+            self.__disk_bytes += size
+
+    def save_index(self):
+        u"""
+            別プロセスからディスクキャッシュを再利用できるよう、indexファイルを書き出す。
+        """
+        with self.__lock:
+            lines = [
+                f"{bucket}\t{key}\t{etag}\n"
+                for (bucket, key), (etag, _, _) in self.__disk_index.items()
+            ]
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = os.path.join(self.cache_dir, "index.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.writelines(lines)
+        os.replace(tmp_path, os.path.join(self.cache_dir, "index"))
@@ -0,0 +1,100 @@
+import os
+import glob
+from abc import ABCMeta, abstractmethod
+from typing import IO, Iterator, Tuple
+import pyarrow as pa
+import pyarrow.csv as pacsv
+
+
+class CsvStreamSource(metaclass=ABCMeta):
+    u"""
+        学習データのCSVをエフェメラルストレージに保存せず、チャンクごとに読み込むためのデータソース。
+        ファイルは set_dataset と同じく、ファイル名(日付)の降順で読み込む。
+        読み込みは pyarrow の CSV ストリーミングリーダーで行うため、メモリ使用量は
+        ファイルサイズに関わらず block_size 程度に収まる。
+    """
+
+    # 1チャンクあたりの読み込みサイズ(byte)
+    BLOCK_SIZE = 8388608  # 8MB
+
+    def __init__(self, block_size: int = BLOCK_SIZE, encoding: str = "utf8"):
+        self.block_size = block_size
+        self.encoding = encoding
+
+    @abstractmethod
+    def iter_files(self) -> Iterator[Tuple[str, IO[bytes]]]:
+        u"""
+            Returns
+            -------
+                (ファイル名, バイナリのファイルオブジェクト) のイテレータ。
+                ファイルオブジェクトは次の要素に進む際に閉じられる。
+        """
+        pass
+
+    def iter_record_batches(self) -> Iterator[Tuple[str, pa.RecordBatch]]:
+        u"""
+            Returns
+            -------
+                (ファイル名, pyarrow.RecordBatch) のイテレータ
+        """
+        read_options = pacsv.ReadOptions(
+            block_size=self.block_size, encoding=self.encoding)
+        for filename, fileobj in self.iter_files():
+            reader = pacsv.open_csv(fileobj, read_options=read_options)
+            for batch in reader:
+                yield filename, batch
+
+    def iter_rows(self) -> Iterator[Tuple[str, dict]]:
+        u"""
+            Returns
+            -------
+                (ファイル名, カラム名 -> 値 の dict) のイテレータ
+        """
+        for filename, batch in self.iter_record_batches():
+            for row in batch.to_pylist():
+                yield filename, row
+
+
+class S3CsvStreamSource(CsvStreamSource):
+    u"""
+        S3のプレフィックス配下のCSVを、GetObjectのレスポンスから直接読み込む。
+    """
+
+    def __init__(self, s3_client, bucket_name: str, prefix: str, **kwargs):
+        super(S3CsvStreamSource, self).__init__(**kwargs)
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+
+    def iter_files(self) -> Iterator[Tuple[str, IO[bytes]]]:
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        keys = [
+            content["Key"]
+            for page in paginator.paginate(Bucket=self.bucket_name, Prefix=self.prefix)
+            for content in page.get("Contents", [])
+            # フォルダなのでskip
+            if content["Key"][-1] != "/"
+        ]
+        for key in sorted(keys, key=lambda k: k.split("/")[-1], reverse=True):
+            body = self.s3_client.get_object(Bucket=self.bucket_name, Key=key)["Body"]
+            try:
+                yield key.split("/")[-1], body
+            finally:
+                body.close()
+
+
+class LocalCsvStreamSource(CsvStreamSource):
+    u"""
+        ローカルのディレクトリ配下のCSVを読み込む。S3の代わりにオンプレ環境や検証で用いる。
+    """
+
+    def __init__(self, dir_path: str, **kwargs):
+        super(LocalCsvStreamSource, self).__init__(**kwargs)
+        self.dir_path = dir_path
+
+    def iter_files(self) -> Iterator[Tuple[str, IO[bytes]]]:
+        # note: globでは角括弧[]をエスケープしないといけない
+        paths = glob.glob(os.path.join(glob.escape(self.dir_path), '*.csv'))
+        for path in sorted(paths, key=os.path.basename, reverse=True):
+            with open(path, "rb") as f:
+                yield os.path.basename(path), f
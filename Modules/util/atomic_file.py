@@ -0,0 +1,58 @@
+import os
+import tempfile
+from contextlib import contextmanager
+
+
+def _get_umask() -> int:
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# 新規ファイルは open() で作った場合と同じパーミッションにする
+_DEFAULT_FILE_MODE = 0o666 & ~_get_umask()
+
+
+@contextmanager
+def atomic_open(path: str, mode: int = None):
+    u"""
+        同じディレクトリの一時ファイルを書き込み用に開き、ブロックを抜けたらリネームで置き換える。
+        読み込み側から書き込み途中のファイルが見えることはなく、途中で失敗しても元のファイルは壊れない。
+
+        Parameters
+        ----------
+            path : str
+                書き込み先のパス。ディレクトリがなければ作成する
+            mode : int, optional
+                書き込み後のパーミッション。省略した場合は既存のファイルのものを引き継ぎ、
+                新規ファイルなら open() で作った場合と同じにする(mkstemp の 0600 のままにはしない)
+    """
+    dir_path = os.path.dirname(os.path.abspath(path))
+    os.makedirs(dir_path, exist_ok=True)
+    if mode is None:
+        try:
+            mode = os.stat(path).st_mode & 0o7777
+        except FileNotFoundError:
+            mode = _DEFAULT_FILE_MODE
+    fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def atomic_write(path: str, data, mode: int = None):
+    u"""
+        data (bytes-like) を atomic_open で書き込む。
+    """
+    with atomic_open(path, mode) as f:
+        f.write(data)
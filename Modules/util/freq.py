@@ -76,3 +76,48 @@ class FreqUtil(object):
 
         # 移動平均計算が終わったので、各カラムが扱うべき日のデータ部分だけに戻す
         return big_df[24:48]
+
+    def roll_summary_append(
+            self,
+            rolled_df: DataFrame,
+            df: DataFrame,
+            new_date: datetime.date,
+            collected_hour: int,
+            end_date: datetime.date
+    ) -> DataFrame:
+        u"""
+            roll_summary済みの集計表に新しい日付のカラムを追加する。
+            移動平均の窓が及ぶのは前後1日分だけなので、新しい日付とその前後の日付のカラムのみを
+            再計算し、それ以外のカラムは rolled_df の値をそのまま使う。
+            保持している日数に関わらず、1日分の追加にかかるコストは一定になる。
+            Parameters
+            ----------
+                rolled_df : DataFrame
+                    前回の roll_summary (または roll_summary_append) の結果
+                df : DataFrame
+                    移動平均をかける前の集計表。形式は roll_summary と同じ。
+                    少なくとも new_date とその前後2日分のカラムが含まれていること。
+                new_date : date
+                    追加する日付
+                collected_hour, end_date :
+                    roll_summary と同じ
+
+            Returns
+            -------
+                rolled_df に new_date のカラムを加え、roll_summary と同じ値になるよう前後の日付を更新した DataFrame
+        """
+
+        # 再計算対象(前日・当日・翌日)のカラムを正しく計算するには、さらにその前後1日分の生データが必要
+        window_dates = [new_date + timedelta(days=d) for d in range(-2, 3)]
+        target_dates = [new_date + timedelta(days=d) for d in range(-1, 2)]
+
+        window_df = df[[d for d in window_dates if d in df.columns]]
+        window_rolled = self.roll_summary(window_df, collected_hour, end_date)
+
+        result = rolled_df.copy()
+        for date_ in target_dates:
+            if date_ in window_rolled.columns:
+                result[date_] = window_rolled[date_]
+
+        # 日付順を roll_summary の結果と揃える
+        return result[sorted(result.columns)]
@@ -1,14 +1,42 @@
 import json
+import base64
 import importlib
+import numpy as np
+import scipy.stats
 
-def decode_from_json(json_path):
+def decode_ndarray(d):
+    """load_pickle.encode_ndarray で変換した dict を ndarray に戻す"""
+    if d["dtype"] == "object":
+        return np.array(decode_attr(d["__ndarray__"]), dtype=object).reshape(d["shape"])
+    # bytearray から作ることで、書き込み可能な配列になる(gaussian_kde は読み取り専用の配列を扱えない)
+    buffer = bytearray(base64.b64decode(d["__ndarray__"]))
+    return np.frombuffer(buffer, dtype=np.dtype(d["dtype"])).reshape(d["shape"])
+
+def decode_attr(val):
+    """JSON の値を再帰的にたどり、型付きで変換された配列を ndarray に、スキーマに従って出力したオブジェクトをインスタンスに戻す"""
+    if isinstance(val, dict):
+        if "__ndarray__" in val:
+            return decode_ndarray(val)
+        if "__schema__" in val:
+            return decode_obj(val)
+        return {k: decode_attr(v) for k, v in val.items()}
+    if isinstance(val, list):
+        return [decode_attr(v) for v in val]
+    return val
+
+def decode_kde(attrs):
+    """load_pickle.encode_kde の出力から gaussian_kde を作り直す。
+    バンド幅の係数をそのまま渡すので、共分散行列は元のモデルと同じになる"""
+    weights = attrs.get("weights")
+    return scipy.stats.gaussian_kde(
+        decode_ndarray(attrs["dataset"]),
+        bw_method=attrs["factor"],
+        weights=decode_ndarray(weights) if weights is not None else None)
+
+def decode_obj(data):
     """
-    JSON ファイルを読み込み、
-    JSON -> Python オブジェクト(そのクラスインスタンス) に復元する
+    __module__ / __class__ 情報付きの dict から Python オブジェクト(そのクラスインスタンス) を復元する
     """
-    with open(json_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-
     # モジュール名とクラス名を取り出す
     module_name = data.get("__module__")
     class_name = data.get("__class__")
@@ -17,6 +45,12 @@ def decode_from_json(json_path):
     if module_name is None or class_name is None:
         raise ValueError("JSON に __module__ / __class__ 情報がありません")
 
+    # scipy のオブジェクトは出力したフィールドから作り直す
+    if "__schema__" in data and module_name == "scipy.stats":
+        if class_name == "gaussian_kde":
+            return decode_kde(attrs)
+        return getattr(scipy.stats, attrs["name"])
+
     # モジュールを動的に import
     module = importlib.import_module(module_name)  # turn0search1
 
@@ -27,10 +61,19 @@ def decode_from_json(json_path):
     inst = cls.__new__(cls)
 
     # 保存された属性を復元
-    inst.__dict__.update(attrs)
+    inst.__dict__.update(decode_attr(attrs))
 
     return inst
 
+def decode_from_json(json_path):
+    """
+    JSON ファイルを読み込み、
+    JSON -> Python オブジェクト(そのクラスインスタンス) に復元する
+    """
+    with open(json_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    return decode_obj(data)
+
 
 if __name__ == "__main__":
     import sys
@@ -2,31 +2,100 @@ import dill
 import protocol
 import sys
 import json
+import base64
 import importlib
+import numpy as np
+from scipy.stats import gaussian_kde, rv_continuous, rv_discrete
+
+# スコア算出に必要なフィールドだけを出力するクラス。(モジュール, クラス名) → フィールド名のリスト
+# 古いモデルに存在しないフィールドは出力しない
+EXPORT_SCHEMAS = {
+    ("Modules.detector.freq2", "SaveData"): [
+        "prob_dens_func", "bw_method", "min_handle", "max_handle", "inflate_size",
+        "inflate_scale", "inflate_model", "min_prob_dens", "normalize_score",
+    ],
+    ("Modules.detector.fpd", "SaveData"): ["fpd"],
+    ("Modules.detector.fpdmodel", "FPDModel"): [
+        "split_char_list", "cutoff", "score_rate", "frequent_paths", "Thresh_fpd",
+    ],
+    ("Modules.detector.feedback_model", "FeedbackModel"): [
+        "fbmodel_data_path", "report_id", "fsname", "whitelist", "frequent_paths_displayed",
+    ],
+}
+SCHEMA_VERSION = 1
+
+def encode_schema_obj(class_name, module_name, attrs):
+    """スキーマに従って出力したオブジェクト。load_json.decode_obj で復元する"""
+    return {"__class__": class_name, "__module__": module_name, "__schema__": SCHEMA_VERSION, "attrs": attrs}
+
+def encode_kde(kde):
+    """gaussian_kde → 再構築に必要なデータ点・重み・バンド幅の係数だけを出力する"""
+    # scipy 1.2 より前の gaussian_kde には重みがない。
+    # 一様な重みは出力しない(復元時に正規化し直すと、わずかに値が変わるため)
+    weights = getattr(kde, "_weights", None)
+    if weights is not None and np.all(weights == weights[0]):
+        weights = None
+    return encode_schema_obj("gaussian_kde", "scipy.stats", {
+        "dataset": encode_ndarray(kde.dataset),
+        "weights": encode_ndarray(weights) if weights is not None else None,
+        "factor": float(kde.factor),
+    })
+
+def encode_distribution(dist):
+    """scipy.stats.norm などの分布 → 名前だけを出力する。_ppfvec などの内部状態は出力しない"""
+    return encode_schema_obj(dist.__class__.__name__, "scipy.stats", {"name": dist.name})
+
+def encode_ndarray(val):
+    """ndarray → dtype と shape 付きで、生のバイト列を base64 にした dict に変換する。
+    str(val) と違い精度が落ちず、省略(...)もされない。load_json.decode_ndarray で復元する"""
+    if val.dtype.hasobject:
+        # オブジェクト配列はバイト列にできないので、入れ子のリストとして変換する
+        return {"__ndarray__": encode_attr(val.tolist()), "dtype": "object", "shape": list(val.shape)}
+    return {
+        "__ndarray__": base64.b64encode(np.ascontiguousarray(val).tobytes()).decode("ascii"),
+        "dtype": val.dtype.str,
+        "shape": list(val.shape),
+    }
 
 def encode_attr(val):
     # 基本型はそのまま
     if isinstance(val, (str, int, float, bool, type(None))):
         return val
+    # numpy 配列 → 型付きで変換
+    if isinstance(val, np.ndarray):
+        return encode_ndarray(val)
+    # numpy のスカラー → Python の値
+    if isinstance(val, np.generic):
+        return val.item()
     # dict → キーと値を再帰的に変換
     if isinstance(val, dict):
         return {k: encode_attr(v) for k, v in val.items()}
     # list / tuple → 再帰的に変換
     if isinstance(val, (list, tuple)):
         return [encode_attr(v) for v in val]
+    # scipy のオブジェクト → 復元に必要な値だけ
+    if isinstance(val, gaussian_kde):
+        return encode_kde(val)
+    if isinstance(val, (rv_continuous, rv_discrete)):
+        return encode_distribution(val)
     # その他オブジェクト → __dict__ を使う（最終的に再帰）
     if hasattr(val, "__dict__"):
-        return { "__class__": val.__class__.__name__,
-                 "__module__": val.__class__.__module__,
-                 "attrs": encode_attr(val.__dict__) }
+        return encode_obj(val)
     # 上記以外は文字列化
     return str(val)
 
 def encode_obj(obj):
     """Python3.6 でロードしたオブジェクトを JSON に変換"""
+    class_name = obj.__class__.__name__
+    module_name = obj.__class__.__module__
+    fields = EXPORT_SCHEMAS.get((module_name, class_name))
+    if fields is not None:
+        return encode_schema_obj(class_name, module_name, {
+            field: encode_attr(obj.__dict__[field]) for field in fields if field in obj.__dict__
+        })
     return {
-        "__class__": obj.__class__.__name__,
-        "__module__": obj.__class__.__module__,
+        "__class__": class_name,
+        "__module__": module_name,
         "attrs": encode_attr(obj.__dict__),
     }
 
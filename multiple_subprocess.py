@@ -1,10 +1,22 @@
-import io
+import mmap
 from scipy.stats import gaussian_kde, norm
 import numpy as np
 import re
 import struct
 import os
+import time
+import json
+import heapq
+import functools
+import queue
+import atexit
+import selectors
+import threading
 import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Callable, Iterable, Iterator, Tuple
+from load_json import decode_attr
 
 def parse_dataset(dataset_str: str) -> list:
     """二次元配列まで、numpy listの文字列をパースする"""
@@ -21,45 +33,483 @@ def parse_dataset(dataset_str: str) -> list:
 
 def get_bytes_dict():
     bytes_dict = {}
+    # BytesIO を経由すると getvalue でもう一度コピーされるので、読んだ bytes をそのまま使う
     with open('0.pkl', 'rb') as f:
-        data = io.BytesIO(f.read())
-        data.seek(0)
-        bytes_dict[1] = data.getvalue()
+        bytes_dict[1] = f.read()
 
     with open('0_copy.pkl', 'rb') as f:
-        data = io.BytesIO(f.read())
-        data.seek(0)
-        bytes_dict[2] = data.getvalue()
+        bytes_dict[2] = f.read()
     return bytes_dict
 
+def map_files(paths: dict[int, str]) -> dict[int, memoryview]:
+    """
+    ファイルをメモリマップし、key → memoryview の辞書を返す。
+    write_payload と組み合わせると、ファイルの内容はページキャッシュから直接パイプに書き込まれ、
+    プロセスのメモリにコピーされない。マップは memoryview が参照しなくなった時点で解放される。
+    """
+    views = {}
+    for key, path in paths.items():
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                views[key] = memoryview(b'')
+                continue
+            views[key] = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    return views
+
 def restore_kde(prob_dens_func_json: any, bw_method):
     """json構造のprob_dens_funcをkde関数にパースする"""
     attrs = prob_dens_func_json["attrs"]
-    dataset = parse_dataset(attrs["dataset"])
+    dataset = attrs["dataset"]
+    if isinstance(dataset, str):
+        # 型付きの変換に対応する前のコンバータは、配列を str(val) で出力している
+        dataset = parse_dataset(dataset)
+    else:
+        dataset = decode_attr(dataset)
     return gaussian_kde(dataset, bw_method=bw_method)
 
-def create_payload(buffers: dict[int, bytes]) -> bytes:
-    payload = bytearray()
+FRAME_HEADER = struct.Struct(">II")  # 4バイト key, 4バイト length
+
+def create_payload(buffers: dict[int, bytes]) -> bytearray:
+    # 全体の長さを先に求めて一度だけ確保し、ヘッダと本体をそれぞれの位置に書き込む
+    size = sum(FRAME_HEADER.size + len(data) for data in buffers.values())
+    payload = bytearray(size)
+
+    offset = 0
+    for key, data in buffers.items():
+        FRAME_HEADER.pack_into(payload, offset, key, len(data))
+        offset += FRAME_HEADER.size
+        payload[offset:offset + len(data)] = data   # 本体
+        offset += len(data)
+
+    return payload
 
+def pack_headers(buffers: dict[int, bytes], end_frame: bool = False) -> Tuple[bytearray, list]:
+    """
+    すべてのフレームのヘッダを1つの確保済みバッファに pack_into で書き込み、
+    (バッファ, 送信順の memoryview のリスト) を返す。本体はコピーせずに参照する。
+    end_frame が True の場合は、最後に (BATCH_END_KEY, 0) のフレームを付ける。
+    """
+    headers = bytearray(FRAME_HEADER.size * (len(buffers) + (1 if end_frame else 0)))
+    header_view = memoryview(headers)
+    vectors = []
+    offset = 0
     for key, data in buffers.items():
-        payload.extend(struct.pack(">I", key))      # 4バイト key
-        payload.extend(struct.pack(">I", len(data)))# 4バイト length
-        payload.extend(data)                        # 本体
+        body = memoryview(data).cast("B")
+        FRAME_HEADER.pack_into(headers, offset, key, len(body))
+        vectors.append(header_view[offset:offset + FRAME_HEADER.size])
+        vectors.append(body)
+        offset += FRAME_HEADER.size
+    if end_frame:
+        FRAME_HEADER.pack_into(headers, offset, BATCH_END_KEY, 0)
+        vectors.append(header_view[offset:offset + FRAME_HEADER.size])
+    return headers, vectors
+
+# 1回の writev に渡せるバッファ数の上限
+IOV_MAX = os.sysconf("SC_IOV_MAX") if hasattr(os, "sysconf") and "SC_IOV_MAX" in os.sysconf_names else 1024
+
+def writev_all(fd: int, vectors: list):
+    """
+    memoryview のリストを os.writev でまとめて fd に書き込む。一部だけ書き込まれた場合は残りを書き直す。
+    os.writev がない環境では1つずつ os.write する。
+    """
+    vectors = [vector for vector in vectors if len(vector)]
+    index = 0
+    while index < len(vectors):
+        if hasattr(os, "writev"):
+            written = os.writev(fd, vectors[index:index + IOV_MAX])
+        else:
+            written = os.write(fd, vectors[index])
+        # 書き込めた分だけ先頭から進める
+        while written > 0:
+            if written >= len(vectors[index]):
+                written -= len(vectors[index])
+                index += 1
+            else:
+                vectors[index] = vectors[index][written:]
+                written = 0
+
+def write_payload(fd: int, buffers: dict[int, bytes], end_frame: bool = False):
+    """
+    create_payload と同じフレームを、ペイロード全体を組み立てずに fd に書き込む。
+    本体(bytes, memoryview, map_files の返り値など)はコピーされない。
+    """
+    _, vectors = pack_headers(buffers, end_frame=end_frame)
+    writev_all(fd, vectors)
+
+def get_converter_script() -> str:
+    # Dockerfileで定義した環境変数
+    TASK_ROOT = os.getenv("LAMBDA_TASK_ROOT")
+    return f"{TASK_ROOT}/Modules/migration/subprocess/pickle_json_converter.bin"
+
+# 常駐モードで1回分のリクエストの終わりを表すフレームのキー(長さは0)
+BATCH_END_KEY = 0xFFFFFFFF
+
+class ConverterWorker:
+    """
+    常駐させた変換プロセス1つ。
+    起動時のインタプリタと dill / scipy の import は一度だけで済む。
+
+    常駐モード(--serve)の変換プロセスとは、以下のフレームでやりとりする。
+      リクエスト : create_payload と同じ (>I key, >I length, 本体) の繰り返しの後に (BATCH_END_KEY, 0)
+      レスポンス : >I length の後に、従来の標準出力と同じ JSON 文字列(UTF-8)
+
+    ストリーミングモード(--stream)では、リクエストは同じで、レスポンスをキーごとに返す(stream を参照)。
+      レスポンス : (>I key, >I length, 1つのオブジェクトの JSON) の繰り返しの後に (BATCH_END_KEY, 0)
+    """
+
+    STDERR_LINES = 50
+
+    def __init__(self, cmd: list):
+        self.cmd = cmd
+        self.proc = None
+        self.stderr_tail = deque(maxlen=self.STDERR_LINES)
+
+    def is_alive(self) -> bool:
+        return self.proc is not None and self.proc.poll() is None
+
+    def start(self):
+        self.stderr_tail.clear()
+        self.proc = subprocess.Popen(
+            self.cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            bufsize=0
+        )
+        # 標準エラーを読まずにいるとパイプが詰まって変換プロセスが止まるので、別スレッドで読み捨てる
+        threading.Thread(target=self.__drain_stderr, args=(self.proc,), daemon=True).start()
+
+    def __drain_stderr(self, proc):
+        for line in proc.stderr:
+            self.stderr_tail.append(line.decode("utf-8", "replace").rstrip())
+
+    def stop(self):
+        if self.proc is None:
+            return
+        try:
+            # 標準入力を閉じると変換プロセスは終了する
+            self.proc.stdin.close()
+            self.proc.wait(timeout=5)
+        except Exception:
+            self.proc.kill()
+            self.proc.wait()
+        self.proc = None
+
+    def kill(self):
+        if self.proc is None:
+            return
+        self.proc.kill()
+        self.proc.wait()
+        self.proc = None
+
+    def request(self, scr_data: dict[int, bytes], timeout: float) -> str:
+        """
+        1回分の pickle バイト辞書を送り、JSON 文字列を受け取る。
+        変換プロセスが落ちていた場合は EOFError、
+        timeout 秒以内に送信と応答が終わらない場合は TimeoutError を送出する。
+        どちらの場合もプロセスは止める。
+        """
+        if not self.is_alive():
+            self.start()
+        deadline = time.monotonic() + timeout
+        # kill で self.proc が外れても、書き込みスレッドが終わるまで標準入力を閉じさせない
+        proc = self.proc
+
+        def write_request(fd):
+            try:
+                write_payload(fd, scr_data, end_frame=True)
+            except OSError:
+                # 変換プロセスが落ちた場合は、読み込み側で EOFError になる
+                pass
+
+        # 変換プロセスが標準入力を読まなくなると書き込みが止まるので、書き込みも別スレッドで行い、
+        # 応答の読み込みと同じ deadline で打ち切る
+        writer = threading.Thread(target=write_request, args=(proc.stdin.fileno(),), daemon=True)
+        writer.start()
+        try:
+            (length,) = struct.unpack(">I", self.__read_exact(4, deadline))
+            return self.__read_exact(length, deadline).decode("utf-8")
+        except BaseException:
+            # 送受信の途中の状態は再利用できないので、プロセスごと捨てる。
+            # プロセスを止めると、書き込み中のスレッドも BrokenPipeError で抜ける
+            self.kill()
+            raise
+        finally:
+            writer.join()
 
-    return bytes(payload)
+    def stream(
+        self,
+        items: Iterable[Tuple[int, bytes]],
+        frame_timeout: float = 60,
+        max_in_flight: int = 8
+    ) -> Iterator[Tuple[int, Any]]:
+        """
+        (key, pickle バイト列) を1つずつ変換プロセスに送り、変換できたものから (key, オブジェクト) を返す。
+        ストリーミングモード(--stream)で起動したプロセスで使う。
+
+        items はジェネレータでもよく、必要になった分だけ読み出す。
+        応答を待っているフレームが max_in_flight 個になると送信を止めるので、メモリに載るのは
+        その分の pickle と、受信中の JSON だけになる。
+        timeout は全体ではなくフレームごとで、応答を待っているフレームがある間に frame_timeout 秒以内に
+        次の応答がなければ、プロセスを止めて RuntimeError を送出する。items の次の要素を待っている間
+        (送信済みのフレームの応答がすべて返っている間)は時間を計らない。
+        途中でイテレーションをやめた場合もプロセスを止める。
+        """
+        if not self.is_alive():
+            self.start()
+        # kill で self.proc が外れても、書き込みスレッドが終わるまで標準入力を閉じさせない
+        proc = self.proc
+        in_flight = threading.Semaphore(max_in_flight)
+        stopped = threading.Event()
+        # 書き込み中または応答待ちのフレーム数と、送信が終わったかどうか
+        state = {"pending": 0, "done": False}
+        state_changed = threading.Condition()
+        writer_errors = []
+
+        def write_frame(key, data):
+            with state_changed:
+                state["pending"] += 1
+                state_changed.notify()
+            write_payload(proc.stdin.fileno(), {key: data})
+
+        def write_frames():
+            try:
+                for key, data in items:
+                    # 応答が追いつくまで送信を待つ
+                    while not in_flight.acquire(timeout=0.1):
+                        if stopped.is_set():
+                            return
+                    write_frame(key, data)
+                write_frame(BATCH_END_KEY, b"")
+            except Exception as e:
+                writer_errors.append(e)
+            finally:
+                with state_changed:
+                    state["done"] = True
+                    state_changed.notify()
+
+        writer = threading.Thread(target=write_frames, daemon=True)
+        writer.start()
+        completed = False
+        try:
+            while True:
+                with state_changed:
+                    # items が次の要素を返すまでは、変換プロセスの応答を待っているわけではない
+                    state_changed.wait_for(lambda: state["pending"] or state["done"])
+                    if not state["pending"] and writer_errors:
+                        raise writer_errors[0]
+                deadline = time.monotonic() + frame_timeout
+                try:
+                    key, length = struct.unpack(">II", self.__read_exact(8, deadline))
+                    if key == BATCH_END_KEY:
+                        break
+                    body = self.__read_exact(length, deadline)
+                except TimeoutError as e:
+                    raise RuntimeError("Subprocess timed out") from e
+                except EOFError as e:
+                    stderr = "\n".join(self.stderr_tail)
+                    raise RuntimeError(f"Subprocess failed: {writer_errors or stderr}") from e
+                with state_changed:
+                    state["pending"] -= 1
+                in_flight.release()
+                yield key, json.loads(body)
+            completed = True
+        finally:
+            stopped.set()
+            if not completed:
+                # 送受信の途中の状態は再利用できないので、プロセスごと捨てる
+                self.kill()
+            writer.join()
+
+    def __read_exact(self, size: int, deadline: float) -> bytes:
+        buffer = bytearray()
+        fd = self.proc.stdout.fileno()
+        with selectors.DefaultSelector() as selector:
+            selector.register(fd, selectors.EVENT_READ)
+            while len(buffer) < size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not selector.select(remaining):
+                    raise TimeoutError("converter did not respond in time")
+                chunk = os.read(fd, size - len(buffer))
+                if not chunk:
+                    raise EOFError("converter exited")
+                buffer.extend(chunk)
+        return bytes(buffer)
+
+class ConverterPool:
+    """
+    常駐させた変換プロセスのプール。
+    convert_pickles_to_jsonarr のように呼び出しごとにプロセスを起動せず、起動済みのプロセスに
+    リクエストを送る。変換プロセスが落ちていた場合は起動し直して、同じリクエストを再送する。
+
+    with ConverterPool(size=2) as pool:
+        json_text = pool.convert(bytes_dict)
+    """
+
+    MAX_RESTARTS = 1
+
+    def __init__(self, size: int = 1, cmd: list = None, timeout: float = 60):
+        self.cmd = cmd or [get_converter_script(), "--in", "-", "--serve"]
+        self.size = size
+        self.timeout = timeout
+        self.__workers = [ConverterWorker(self.cmd) for _ in range(size)]
+        self.__idle = queue.Queue()
+        for worker in self.__workers:
+            self.__idle.put(worker)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, ex_type, ex_value, trace):
+        self.close()
+
+    def convert(self, scr_data: dict[int, bytes], timeout: float = None) -> str:
+        timeout = timeout or self.timeout
+        worker = self.__idle.get()
+        try:
+            for attempt in range(self.MAX_RESTARTS + 1):
+                try:
+                    return worker.request(scr_data, timeout)
+                except (BrokenPipeError, EOFError) as e:
+                    stderr = "\n".join(worker.stderr_tail)
+                    worker.kill()
+                    if attempt == self.MAX_RESTARTS:
+                        raise RuntimeError(f"Subprocess failed: {stderr}") from e
+                except TimeoutError as e:
+                    # 応答途中のデータが残っているかもしれないので、プロセスごと捨てる
+                    worker.kill()
+                    raise RuntimeError("Subprocess timed out") from e
+        finally:
+            self.__idle.put(worker)
+
+    def close(self):
+        for worker in self.__workers:
+            worker.stop()
+
+def stream_pickles_to_json(
+    items: Iterable[Tuple[int, bytes]],
+    frame_timeout: float = 60,
+    max_in_flight: int = 8,
+    worker: ConverterWorker = None
+) -> Iterator[Tuple[int, Any]]:
+    """
+    convert_pickles_to_jsonarr のストリーミング版。リクエスト全体やレスポンス全体をメモリに持たず、
+    変換できたものから (key, オブジェクト) を返す。
+
+    worker を指定しない場合は、ストリーミングモードの変換プロセスをこの呼び出しの間だけ起動する。
+    """
+    owned = worker is None
+    if owned:
+        worker = ConverterWorker([get_converter_script(), "--in", "-", "--stream"])
+    try:
+        yield from worker.stream(items, frame_timeout=frame_timeout, max_in_flight=max_in_flight)
+    finally:
+        if owned:
+            worker.stop()
+
+def shard_by_size(buffers: dict[int, bytes], shard_count: int) -> list:
+    """
+    {key: bytes} を合計サイズがなるべく均等になるように shard_count 個以下の辞書に分ける。
+    大きいものから順に、その時点で最も小さいシャードに入れる。
+    """
+    shard_count = max(1, min(shard_count, len(buffers)))
+    shards = [{} for _ in range(shard_count)]
+    heap = [(0, i) for i in range(shard_count)]
+    for key, data in sorted(buffers.items(), key=lambda item: len(item[1]), reverse=True):
+        size, i = heapq.heappop(heap)
+        shards[i][key] = data
+        heapq.heappush(heap, (size + len(data), i))
+    return [shard for shard in shards if shard]
+
+def convert_sharded(
+    scr_data: dict[int, bytes],
+    workers: int = None,
+    pool: ConverterPool = None,
+    timeout: float = None,
+    convert_func: Callable[[dict[int, bytes]], str] = None
+) -> Tuple[dict, dict]:
+    """
+    pickle バイト辞書をサイズが均等なシャードに分け、複数の変換プロセスで並列に変換する。
+    変換に失敗したシャードは半分に分けて再送し、1件になっても失敗したものだけを失敗として返す。
+    壊れた pickle が1つあっても、他のモデルの変換結果は得られる。
+
+    変換結果の JSON 配列の要素は、シャードのキーの順に対応しているものとする。
+
+    Parameters
+    ----------
+        workers : int, optional
+            並列に変換するシャード数。指定しない場合は pool の大きさ、pool もなければ CPU 数
+        pool : ConverterPool, optional
+            指定した場合は、常駐させた変換プロセスにシャードを送る
+        timeout : float, optional
+            シャード1つの変換のタイムアウト(秒)
+        convert_func : callable, optional
+            シャード({key: bytes})を変換して JSON 配列の文字列を返す関数。
+            pool も convert_func も指定しない場合は、シャードごとに convert_pickles_to_jsonarr で
+            変換プロセスを起動する
+
+    Returns
+    -------
+        (key → 変換したオブジェクト, key → エラーメッセージ)
+    """
+    if convert_func is None:
+        if pool is not None:
+            convert_func = functools.partial(pool.convert, timeout=timeout)
+        else:
+            convert_func = functools.partial(convert_pickles_to_jsonarr, timeout=timeout or 60)
+    if workers is None:
+        workers = pool.size if pool is not None else os.cpu_count() or 1
+
+    results = {}
+    failures = {}
+
+    def convert(shard):
+        converted = json.loads(convert_func(shard))
+        if len(converted) != len(shard):
+            raise RuntimeError(f"expected {len(shard)} results, got {len(converted)}")
+        return dict(zip(shard.keys(), converted))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {
+            executor.submit(convert, shard): shard
+            for shard in shard_by_size(scr_data, workers)
+        }
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                shard = pending.pop(future)
+                try:
+                    results.update(future.result())
+                except Exception as e:
+                    if len(shard) == 1:
+                        failures.update({key: str(e) for key in shard})
+                        continue
+                    # 失敗したシャードを分けて送り直し、原因のモデルを絞り込む
+                    for sub_shard in shard_by_size(shard, 2):
+                        pending[executor.submit(convert, sub_shard)] = sub_shard
+    return results, failures
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+def get_converter_pool() -> ConverterPool:
+    """プロセス内で共有するプール。Lambda ではコンテナが再利用される間、変換プロセスも再利用される"""
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = ConverterPool()
+            atexit.register(_default_pool.close)
+        return _default_pool
 
 def convert_pickles_to_jsonarr(scr_data: dict[int, bytes], timeout: int = 60) -> str:
     """
     サブプロセスで Python 3.6 を使用して、
     pickle バイト辞書を stdin 経由で渡し、
     JSON 文字列を stdout から受け取る。
+    呼び出しごとにプロセスを起動する。繰り返し呼ぶ場合は ConverterPool を使うこと。
     """
 
-    # Dockerfileで定義した環境変数
-    TASK_ROOT = os.getenv("LAMBDA_TASK_ROOT")
-    CONVERTER_SCRIPT = f"{TASK_ROOT}/Modules/migration/subprocess/pickle_json_converter.bin"
-
-    cmd = [CONVERTER_SCRIPT, "--in", "-"]
+    cmd = [get_converter_script(), "--in", "-"]
     try:
         proc = subprocess.run(
             cmd,
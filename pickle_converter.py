@@ -1,12 +1,19 @@
 import dill
 import sys
+import os
+import glob
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import protocol
+import pickle_rewriter
+from Modules.util.atomic_file import atomic_open
 
 def get_pickle_protocol(filename: str) -> int:
     with open(filename, "rb") as f:
         header = f.read(2)  # PROTOマーカー + version バイト
-    # header は b"\x80\x05" のような形式なので、index 1 がプロトコル番号
-    if header and header[0] == 0x80:
-        return header[1]
+    # プロトコル 0/1 の場合は None を返し、変換対象にする
+    return protocol.get_pickle_protocol_from_header(header)
 
 def convert_pickle(filename: str, target_protocol: int) -> None:
     with open(filename, "rb") as f:
@@ -15,13 +22,95 @@ def convert_pickle(filename: str, target_protocol: int) -> None:
     with open(filename, "wb") as f:
         dill.dump(obj, f, protocol=target_protocol)
 
+def convert_pickle_atomic(filename: str, target_protocol: int) -> None:
+    """同じディレクトリの一時ファイルに書き出してからリネームする。途中で失敗しても元のファイルは壊れない"""
+    with open(filename, "rb") as f:
+        obj = dill.load(f)
+
+    # パーミッションは元のファイルのものを引き継ぐ
+    with atomic_open(filename) as f:
+        dill.dump(obj, f, protocol=target_protocol)
+
+def convert_one(filename: str, target_protocol: int, rewrite: bool = False):
+    """プロセスプールのワーカー。(ファイル名, 状態, サイズ, エラー) を返す"""
+    try:
+        size = os.path.getsize(filename)
+        if get_pickle_protocol(filename) == target_protocol:
+            return filename, "skipped", size, None
+        if rewrite:
+            # オペコードの書き換えで変換できない場合だけ dill でロードし直す
+            try:
+                pickle_rewriter.rewrite_file(filename, target_protocol)
+                return filename, "converted", size, None
+            except ValueError:
+                pass
+        convert_pickle_atomic(filename, target_protocol)
+        return filename, "converted", size, None
+    except Exception as e:
+        return filename, "failed", 0, f"{type(e).__name__}: {e}"
+
+def iter_inputs(inputs):
+    """ファイル名・globパターン、"-" の場合は標準入力の各行を入力とする"""
+    for pattern in inputs:
+        if pattern == "-":
+            for line in sys.stdin:
+                line = line.strip()
+                if line:
+                    yield line
+        elif glob.has_magic(pattern):
+            yield from glob.iglob(pattern, recursive=True)
+        else:
+            yield pattern
+
+def convert_batch(inputs, target_protocol: int, workers: int = None, rewrite: bool = False) -> int:
+    """複数ファイルをプロセスプールで変換し、結果を標準エラーに出力する。失敗したファイル数を返す"""
+    counts = {"converted": 0, "skipped": 0, "failed": 0}
+    failures = []
+    total_bytes = 0
+    started = time.monotonic()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(convert_one, filename, target_protocol, rewrite)
+                   for filename in iter_inputs(inputs)]
+        for i, future in enumerate(as_completed(futures), 1):
+            filename, status, size, error = future.result()
+            counts[status] += 1
+            if status == "converted":
+                total_bytes += size
+            if error is not None:
+                failures.append((filename, error))
+            if i % 1000 == 0:
+                print(f"{i}/{len(futures)} files", file=sys.stderr)
+
+    elapsed = time.monotonic() - started
+    done = sum(counts.values())
+    rate = done / elapsed if elapsed > 0 else 0
+    throughput = total_bytes / elapsed / 1048576 if elapsed > 0 else 0
+    print(f"converted: {counts['converted']}, skipped: {counts['skipped']}, failed: {counts['failed']}", file=sys.stderr)
+    print(f"elapsed: {elapsed:.2f} s, {rate:.1f} files/s, {throughput:.2f} MB/s", file=sys.stderr)
+    for filename, error in failures:
+        print(f"FAILED {filename}: {error}", file=sys.stderr)
+    return counts["failed"]
+
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--batch":
+        # python pickle_converter.py --batch <target_protocol> [--workers N] [--rewrite] <file or glob or -> ...
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--batch", action="store_true")
+        parser.add_argument("target_protocol", type=int)
+        parser.add_argument("inputs", nargs="+")
+        parser.add_argument("--workers", type=int, default=None)
+        parser.add_argument("--rewrite", action="store_true")
+        args = parser.parse_args()
+        failed = convert_batch(args.inputs, args.target_protocol, workers=args.workers, rewrite=args.rewrite)
+        exit(1 if failed else 0)
+
     in_file = sys.argv[1]
     target_proto = int(sys.argv[2])
 
     current_proto = get_pickle_protocol(in_file)
     if current_proto == target_proto:
         exit(0)
-    
-    convert_pickle(in_file, target_proto)
\ No newline at end of file
+
+    convert_pickle(in_file, target_proto)
@@ -0,0 +1,264 @@
+"""
+pickle をアンピックルせずに、オペコード列を書き換えてプロトコルを変換する。
+
+dill.load でのロードは参照しているクラス(scipy, Modules.detector など)をすべて import する必要があり、
+遅いうえに、それらがない環境では変換できない。ここではオペコード列を pickletools で解析して
+PROTO とフレーミングを付け替え、変換先のプロトコルにないオペコードを同等のものに置き換える。
+REDUCE などは実行しないので、変換に必要なのは標準ライブラリだけ。
+
+python pickle_rewriter.py <input.pkl> <target_protocol> [<output.pkl>]
+
+対応しているのは変換先がプロトコル 2 以上の場合。以下のオペコードを置き換える。
+  - FRAME : 一度すべて取り除き、変換先が 4 以上なら付け直す
+  - SHORT_BINUNICODE, BINUNICODE8 -> BINUNICODE (変換先が 4 未満)
+  - MEMOIZE -> BINPUT / LONG_BINPUT (変換先が 4 未満)
+  - STACK_GLOBAL -> POP, POP, GLOBAL (変換先が 4 未満。モジュール名と属性名が静的に分かり、
+    属性名が修飾名(a.b)でない場合のみ)
+  - BINPUT -> MEMOIZE, BINUNICODE -> SHORT_BINUNICODE (変換先が 4 以上の場合の縮小)
+  - GLOBAL : プロトコル 3 をまたぐ場合は fix_imports と同じく Python 2 のモジュール名を読み替える
+置き換えられないオペコード(NEWOBJ_EX, set のオペコード, プロトコル 5 のバッファなど)や、
+変換先が 4 未満で修飾名の GLOBAL を含む場合は ValueError を送出する。
+"""
+
+import io
+import os
+import sys
+import struct
+import pickletools
+import _compat_pickle
+from Modules.util.atomic_file import atomic_write
+
+PROTO = b"\x80"
+FRAME = b"\x95"
+BINUNICODE = b"X"
+SHORT_BINUNICODE = b"\x8c"
+BINPUT = b"q"
+LONG_BINPUT = b"r"
+MEMOIZE = b"\x94"
+GLOBAL = b"c"
+POP = b"0"
+
+# pickle モジュールの Pickler と同じフレームの目安サイズ
+FRAME_SIZE_TARGET = 64 * 1024
+
+_STRING_OPCODES = {
+    "SHORT_BINUNICODE", "BINUNICODE", "BINUNICODE8", "UNICODE",
+    "SHORT_BINSTRING", "BINSTRING", "STRING",
+}
+_MEMO_GET_OPCODES = {"GET", "BINGET", "LONG_BINGET"}
+_MEMO_PUT_OPCODES = {"PUT", "BINPUT", "LONG_BINPUT"}
+# 変換先のプロトコルでは表現できないため、書き換えに対応していないオペコード
+_UNSUPPORTED_BELOW = {
+    "NEWOBJ_EX": 4,
+    "EMPTY_SET": 4,
+    "ADDITEMS": 4,
+    "FROZENSET": 4,
+    "BYTEARRAY8": 5,
+    "NEXT_BUFFER": 5,
+    "READONLY_BUFFER": 5,
+    "BINBYTES": 3,
+    "SHORT_BINBYTES": 3,
+    "BINBYTES8": 4,
+}
+
+# dill がプロトコルによらずこの名前で書き込み、Unpickler.find_class で特別扱いするもの
+_DILL_SPECIAL_GLOBALS = {("__builtin__", "__main__"), ("__builtin__", "NoneType")}
+
+
+def _encode_unicode(value: str, target_protocol: int) -> bytes:
+    encoded = value.encode("utf-8", "surrogatepass")
+    if target_protocol >= 4 and len(encoded) < 256:
+        return SHORT_BINUNICODE + struct.pack("<B", len(encoded)) + encoded
+    if len(encoded) >= 2 ** 32:
+        raise ValueError("string too long for protocol < 4")
+    return BINUNICODE + struct.pack("<I", len(encoded)) + encoded
+
+
+def _encode_put(index: int) -> bytes:
+    if index < 256:
+        return BINPUT + struct.pack("<B", index)
+    return LONG_BINPUT + struct.pack("<I", index)
+
+
+def _fix_global(module_name: str, attr_name: str, source_protocol: int, target_protocol: int):
+    u"""
+        プロトコル 3 をまたぐ場合は、Pickler / Unpickler の fix_imports と同じく
+        Python 2 と 3 のモジュール名を読み替える。
+    """
+    if (module_name, attr_name) in _DILL_SPECIAL_GLOBALS:
+        return module_name, attr_name
+    if source_protocol < 3 <= target_protocol:
+        if (module_name, attr_name) in _compat_pickle.NAME_MAPPING:
+            module_name, attr_name = _compat_pickle.NAME_MAPPING[(module_name, attr_name)]
+        elif module_name in _compat_pickle.IMPORT_MAPPING:
+            module_name = _compat_pickle.IMPORT_MAPPING[module_name]
+    elif target_protocol < 3 <= source_protocol:
+        if (module_name, attr_name) in _compat_pickle.REVERSE_NAME_MAPPING:
+            module_name, attr_name = _compat_pickle.REVERSE_NAME_MAPPING[(module_name, attr_name)]
+        elif module_name in _compat_pickle.REVERSE_IMPORT_MAPPING:
+            module_name = _compat_pickle.REVERSE_IMPORT_MAPPING[module_name]
+    return module_name, attr_name
+
+
+def _check_global_name(attr_name: str, target_protocol: int):
+    # プロトコル 4 未満の Unpickler は属性名をそのまま getattr するので、
+    # 入れ子のクラスやメソッド(gaussian_kde.scotts_factor など)の修飾名は解決できない
+    if target_protocol < 4 and "." in attr_name:
+        raise ValueError(f"qualified name {attr_name!r} cannot be expressed in protocol {target_protocol}")
+
+
+def _encode_global(module_name: str, attr_name: str) -> bytes:
+    return GLOBAL + f"{module_name}\n{attr_name}\n".encode("utf-8")
+
+
+def _iter_ops(data: bytes):
+    u"""
+        (opcode, arg, 生バイト列) を返す。
+    """
+    ops = list(pickletools.genops(data))
+    for i, (opcode, arg, pos) in enumerate(ops):
+        end = ops[i + 1][2] if i + 1 < len(ops) else pos + 1
+        yield opcode, arg, data[pos:end]
+
+
+def _frame_ops(op_bytes_list) -> bytes:
+    out = io.BytesIO()
+    frame = io.BytesIO()
+
+    def commit():
+        if frame.tell() == 0:
+            return
+        out.write(FRAME + struct.pack("<Q", frame.tell()))
+        out.write(frame.getvalue())
+        frame.seek(0)
+        frame.truncate()
+
+    for op_bytes in op_bytes_list:
+        # オペコードがフレームの境界をまたがないよう、目安サイズを超えたら次のフレームにする
+        if frame.tell() and frame.tell() + len(op_bytes) > FRAME_SIZE_TARGET:
+            commit()
+        frame.write(op_bytes)
+    commit()
+    return out.getvalue()
+
+
+def rewrite_protocol(data: bytes, target_protocol: int) -> bytes:
+    u"""
+        pickle のバイト列をアンピックルせずに target_protocol のものに変換する。
+
+        Raises
+        ------
+            ValueError : 変換先で表現できないオペコードを含む場合
+    """
+    if target_protocol < 2 or target_protocol > 5:
+        raise ValueError(f"unsupported target protocol: {target_protocol}")
+
+    ops_out = []
+    # STACK_GLOBAL の引数を静的に得るため、文字列のpushとメモを追跡する。
+    # 文字列以外をスタックに積む(もしくは取り除く)オペコードでは None を積み、対応を切る
+    pushed = []
+    memo = {}
+    source_protocol = 0
+
+    for opcode, arg, raw in _iter_ops(data):
+        name = opcode.name
+        if name == "PROTO":
+            source_protocol = arg
+            continue
+        if name == "FRAME":
+            continue
+
+        min_proto = _UNSUPPORTED_BELOW.get(name)
+        if min_proto is not None and target_protocol < min_proto:
+            raise ValueError(f"{name} cannot be expressed in protocol {target_protocol}")
+
+        if name in _STRING_OPCODES:
+            value = arg if isinstance(arg, str) else None
+            pushed.append(value)
+            if name in ("SHORT_BINUNICODE", "BINUNICODE", "BINUNICODE8"):
+                raw = _encode_unicode(arg, target_protocol)
+        elif name in _MEMO_GET_OPCODES:
+            pushed.append(memo.get(arg))
+        elif name in _MEMO_PUT_OPCODES:
+            is_next_index = arg not in memo and arg == len(memo)
+            memo[arg] = pushed[-1] if pushed else None
+            if target_protocol >= 4 and is_next_index:
+                # 連番で格納している場合は MEMOIZE で代替できる
+                raw = MEMOIZE
+        elif name == "MEMOIZE":
+            index = len(memo)
+            memo[index] = pushed[-1] if pushed else None
+            if target_protocol < 4:
+                raw = _encode_put(index)
+        elif name == "GLOBAL":
+            # arg は "module name" の形式
+            module_name, attr_name = arg.split(" ", 1)
+            fixed = _fix_global(module_name, attr_name, source_protocol, target_protocol)
+            _check_global_name(fixed[1], target_protocol)
+            if fixed != (module_name, attr_name):
+                raw = _encode_global(*fixed)
+            pushed.append(None)
+        elif name == "STACK_GLOBAL":
+            if target_protocol < 4:
+                module_name, attr_name = pushed[-2:] if len(pushed) >= 2 else (None, None)
+                if not isinstance(module_name, str) or not isinstance(attr_name, str):
+                    raise ValueError("STACK_GLOBAL arguments are not statically known")
+                fixed = _fix_global(module_name, attr_name, source_protocol, target_protocol)
+                _check_global_name(fixed[1], target_protocol)
+                # 積まれた文字列はメモから参照されている可能性があるので、そのまま残して取り除く
+                raw = POP + POP + _encode_global(*fixed)
+            pushed.append(None)
+        else:
+            pushed.append(None)
+
+        if len(pushed) > 16:
+            del pushed[:-2]
+        ops_out.append(raw)
+
+    header = PROTO + struct.pack("<B", target_protocol)
+    if target_protocol >= 4:
+        return header + _frame_ops(ops_out)
+    return header + b"".join(ops_out)
+
+
+def verify_protocol(data: bytes, target_protocol: int):
+    u"""
+        変換後のバイト列を pickletools で最後まで解析し、target_protocol の pickle として
+        読めることを確かめる。アンピックルはしない。
+
+        Raises
+        ------
+            ValueError : オペコード列が壊れている、STOP の後にデータが残っている、
+                         もしくは PROTO が target_protocol でない場合
+    """
+    if data[:2] != PROTO + struct.pack("<B", target_protocol):
+        raise ValueError(f"rewritten pickle does not start with protocol {target_protocol}")
+    end = None
+    try:
+        for _, _, pos in pickletools.genops(data):
+            end = pos + 1
+    except Exception as e:
+        raise ValueError(f"rewritten pickle is broken: {e}") from e
+    if end != len(data):
+        raise ValueError("rewritten pickle has trailing data after STOP")
+
+
+def rewrite_file(filename: str, target_protocol: int, out_filename: str = None) -> None:
+    u"""
+        ファイルを変換する。out_filename を指定しない場合は、一時ファイルを経由して上書きする。
+        変換後のバイト列を verify_protocol で確かめてから置き換える。
+    """
+    with open(filename, "rb") as f:
+        data = f.read()
+    rewritten = rewrite_protocol(data, target_protocol)
+    verify_protocol(rewritten, target_protocol)
+
+    # 変換後のファイルのパーミッションは変換元に合わせる
+    atomic_write(out_filename or filename, rewritten, mode=os.stat(filename).st_mode & 0o7777)
+
+
+if __name__ == "__main__":
+    in_file = sys.argv[1]
+    target_proto = int(sys.argv[2])
+    out_file = sys.argv[3] if len(sys.argv) > 3 else None
+    rewrite_file(in_file, target_proto, out_file)
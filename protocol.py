@@ -1,7 +1,18 @@
+def get_pickle_protocol_from_header(header: bytes) -> int:
+    u"""
+        pickle の先頭2バイトからプロトコルバージョンを返す。
+        PROTO オペコードがない場合(プロトコル 0/1)は None を返す。
+    """
+    # header は b"\x80\x05" のような形式なので、index 1 がプロトコル番号
+    if len(header) >= 2 and header[0] == 0x80:
+        return header[1]
+    return None
+
+
 def get_pickle_protocol(filename: str) -> int:
     with open(filename, "rb") as f:
         header = f.read(2)  # PROTOマーカー + version バイト
-    # header は b"\x80\x05" のような形式なので、index 1 がプロトコル番号
-    if header and header[0] == 0x80:
-        return header[1]
+    proto = get_pickle_protocol_from_header(header)
+    if proto is not None:
+        return proto
     raise ValueError("プロトコル情報が見つかりません")
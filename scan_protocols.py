@@ -0,0 +1,212 @@
+"""
+大量の pickle ファイルのプロトコルと、オペコード中で参照しているモジュールを集計する。
+dill / Python のアップデート前に、既存モデルの状況を確認するために用いる。
+
+python scan_protocols.py <dir or s3://bucket/prefix> [--refs] [--workers N] [--suffix .pkl]
+
+通常はヘッダ(先頭2バイト)だけを読む。S3の場合は範囲GETで先頭だけを取得する。
+PROTO オペコードのないプロトコル 0/1 のファイルと、--refs を指定した場合は
+オペコード列全体を読んで、GLOBAL/STACK_GLOBAL で参照しているモジュールを数える。
+"""
+
+import os
+import sys
+import argparse
+import pickletools
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, Tuple
+import protocol
+
+# 文字列をスタックに積むオペコード
+_STRING_OPCODES = {
+    "SHORT_BINUNICODE", "BINUNICODE", "BINUNICODE8", "UNICODE",
+    "SHORT_BINSTRING", "BINSTRING", "STRING",
+}
+_MEMO_GET_OPCODES = {"GET", "BINGET", "LONG_BINGET"}
+_MEMO_PUT_OPCODES = {"PUT", "BINPUT", "LONG_BINPUT"}
+
+
+def scan_opcodes(data: bytes) -> Tuple[int, Counter]:
+    u"""
+        オペコード列を走査し、(プロトコル, 参照しているグローバル名の Counter) を返す。
+        REDUCE などは実行しないので、参照しているモジュールがインストールされていなくてもよい。
+        プロトコルは PROTO があればその値、なければ使われているオペコードの最大プロトコル(0 か 1)。
+    """
+    refs = Counter()
+    proto = None
+    max_opcode_proto = 0
+    # STACK_GLOBAL の引数を得るため、文字列のpushとメモだけを追跡する
+    pushed = []
+    memo = {}
+    for opcode, arg, _ in pickletools.genops(data):
+        max_opcode_proto = max(max_opcode_proto, opcode.proto)
+        name = opcode.name
+        if name == "PROTO":
+            proto = arg
+        elif name in _STRING_OPCODES:
+            pushed.append(arg if isinstance(arg, str) else arg.decode("latin-1"))
+        elif name in _MEMO_GET_OPCODES:
+            pushed.append(memo.get(arg))
+        elif name in _MEMO_PUT_OPCODES:
+            memo[arg] = pushed[-1] if pushed else None
+        elif name == "MEMOIZE":
+            memo[len(memo)] = pushed[-1] if pushed else None
+        elif name == "GLOBAL":
+            # arg は "module name" の形式
+            refs[arg.replace(" ", ".", 1)] += 1
+        elif name == "STACK_GLOBAL":
+            module_name, attr_name = pushed[-2:] if len(pushed) >= 2 else (None, None)
+            refs[f"{module_name}.{attr_name}"] += 1
+            pushed.append(None)
+        elif name == "FRAME":
+            # フレームの区切りはスタックに影響しない
+            pass
+        else:
+            # 文字列以外が積まれたので、直前の文字列との対応を切る
+            pushed.append(None)
+        if len(pushed) > 16:
+            del pushed[:-2]
+    if proto is None:
+        proto = max_opcode_proto
+    return proto, refs
+
+
+def scan_bytes(header: bytes, read_all, with_refs: bool) -> Tuple[int, Counter]:
+    u"""
+        Parameters
+        ----------
+            header : bytes
+                先頭2バイト以上
+            read_all : callable
+                オブジェクト全体を返す関数。必要な場合だけ呼ばれる
+    """
+    proto = protocol.get_pickle_protocol_from_header(header)
+    if proto is not None and not with_refs:
+        return proto, Counter()
+    return scan_opcodes(read_all())
+
+
+def iter_local_files(root: str, suffix: str) -> Iterator[str]:
+    if os.path.isfile(root):
+        yield root
+        return
+    for dir_path, _, filenames in os.walk(root):
+        for filename in filenames:
+            if filename.endswith(suffix):
+                yield os.path.join(dir_path, filename)
+
+
+def scan_local_file(path: str, with_refs: bool) -> Tuple[int, Counter]:
+    with open(path, "rb") as f:
+        header = f.read(2)
+
+        def read_all():
+            f.seek(0)
+            return f.read()
+
+        return scan_bytes(header, read_all, with_refs)
+
+
+def iter_s3_keys(s3_client, bucket: str, prefix: str, suffix: str) -> Iterator[str]:
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for content in page.get("Contents", []):
+            key = content["Key"]
+            if key[-1] != "/" and key.endswith(suffix):
+                yield key
+
+
+def scan_s3_object(s3_client, bucket: str, key: str, with_refs: bool) -> Tuple[int, Counter]:
+    if with_refs:
+        data = s3_client.get_object(Bucket=bucket, Key=key)["Body"].read()
+        return scan_bytes(data[:2], lambda: data, with_refs)
+    header = s3_client.get_object(Bucket=bucket, Key=key, Range="bytes=0-1")["Body"].read()
+    return scan_bytes(
+        header,
+        lambda: s3_client.get_object(Bucket=bucket, Key=key)["Body"].read(),
+        with_refs)
+
+
+def scan(
+    target: str,
+    with_refs: bool = False,
+    workers: int = 16,
+    suffix: str = ""
+) -> Tuple[Counter, Counter, Counter, list]:
+    u"""
+        Parameters
+        ----------
+            target : str
+                ディレクトリ、ファイル、もしくは s3://bucket/prefix
+            suffix : str
+                対象とするファイル名の末尾。S3のモデルのように拡張子がない場合は空文字
+
+        Returns
+        -------
+            (プロトコルごとのファイル数, トップレベルのモジュールごとの参照ファイル数,
+             グローバル名ごとの参照回数, 読み込めなかったファイルの (パス, エラー) のリスト)
+    """
+    if target.startswith("s3://"):
+        import boto3
+        bucket, _, prefix = target[len("s3://"):].partition("/")
+        s3_client = boto3.client("s3")
+        paths: Iterable[str] = iter_s3_keys(s3_client, bucket, prefix, suffix)
+
+        def scan_one(path):
+            return scan_s3_object(s3_client, bucket, path, with_refs)
+    else:
+        paths = iter_local_files(target, suffix)
+
+        def scan_one(path):
+            return scan_local_file(path, with_refs)
+
+    protocols = Counter()
+    modules = Counter()
+    globals_ = Counter()
+    errors = []
+
+    def run(path):
+        try:
+            return path, scan_one(path), None
+        except Exception as e:
+            return path, None, e
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for path, result, error in executor.map(run, paths):
+            if error is not None:
+                errors.append((path, error))
+                continue
+            proto, refs = result
+            protocols[proto] += 1
+            globals_.update(refs)
+            modules.update({name.split(".")[0] for name in refs})
+    return protocols, modules, globals_, errors
+
+
+def print_table(title: str, counter: Counter, file=sys.stdout):
+    print(f"{title}", file=file)
+    width = max([len(str(key)) for key in counter] + [8])
+    for key, count in counter.most_common():
+        print(f"  {str(key):<{width}}  {count:>10}", file=file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="pickle ファイルのプロトコルと参照モジュールを集計する")
+    parser.add_argument("target", help="ディレクトリ、ファイル、もしくは s3://bucket/prefix")
+    parser.add_argument("--refs", action="store_true", help="オペコード列全体を読み、参照しているモジュールも集計する")
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--suffix", default="")
+    args = parser.parse_args()
+
+    protocols, modules, globals_, errors = scan(
+        args.target, with_refs=args.refs, workers=args.workers, suffix=args.suffix)
+
+    print_table("protocol", protocols)
+    if args.refs:
+        print_table("module (files)", modules)
+        print_table("global (references)", globals_)
+    if errors:
+        print(f"errors: {len(errors)}", file=sys.stderr)
+        for path, error in errors[:20]:
+            print(f"  {path}: {error}", file=sys.stderr)
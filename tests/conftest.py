@@ -0,0 +1,38 @@
+import os
+import sys
+import types
+import importlib.util
+
+# リポジトリ直下のスクリプト(multiple_subprocess.py など)と Modules を import できるようにする
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class _AwsScoreDb(object):
+    u"""
+        score_db.AwsScoreDb の代わり。スコアは output_dir の下に置かれるファイルとして扱う
+    """
+
+    def __init__(self, output_dir: str):
+        self.output_dir = output_dir
+
+
+class _AwsModelDb(object):
+    def __init__(self, aws_id, mgmt_id, table_name):
+        raise RuntimeError("tests must not access the model DB on AWS")
+
+
+class _ReportModelStatus(object):
+    pass
+
+
+def _install_stub(name: str, **attrs):
+    # score_db / model_db はこのリポジトリの外にあるモジュールなので、ない場合だけ差し替える
+    if importlib.util.find_spec(name) is not None:
+        return
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+
+
+_install_stub("score_db", AwsScoreDb=_AwsScoreDb)
+_install_stub("model_db", AwsModelDb=_AwsModelDb, ReportModelStatus=_ReportModelStatus)
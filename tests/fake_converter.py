@@ -0,0 +1,79 @@
+u"""
+    テスト用の変換プロセス。pickle は読まず、受け取ったフレームの長さを JSON で返す。
+
+    python fake_converter.py --in -   : convert_pickles_to_jsonarr と同じく、標準入力を読み切ってから応答する
+    python fake_converter.py --serve  : ConverterWorker.request のフレームでやりとりする
+    python fake_converter.py --stream : ConverterWorker.stream のフレームでやりとりする
+
+    環境変数
+        FAKE_CONVERTER_STALL : 1 の場合、標準入力を読まずに止まる
+
+    本体が b"BAD" で始まるフレームを含むリクエストは、変換に失敗したものとして終了コード 1 で終わる。
+"""
+import os
+import sys
+import json
+import time
+import struct
+
+BATCH_END_KEY = 0xFFFFFFFF
+
+
+def read_exact(inp, size):
+    data = inp.read(size)
+    if len(data) < size:
+        sys.exit(0)
+    return data
+
+
+def convert(data):
+    if data.startswith(b"BAD"):
+        print("bad pickle", file=sys.stderr)
+        sys.exit(1)
+    return {"len": len(data)}
+
+
+def convert_once(inp, out):
+    results = []
+    while True:
+        header = inp.read(8)
+        if len(header) < 8:
+            break
+        _, length = struct.unpack(">II", header)
+        results.append(convert(inp.read(length)))
+    out.write(json.dumps(results).encode())
+
+
+def main():
+    inp = sys.stdin.buffer
+    out = sys.stdout.buffer
+    if os.environ.get("FAKE_CONVERTER_STALL") == "1":
+        time.sleep(60)
+        return
+    if "--serve" not in sys.argv and "--stream" not in sys.argv:
+        convert_once(inp, out)
+        return
+    stream = "--stream" in sys.argv
+    lengths = []
+    while True:
+        key, length = struct.unpack(">II", read_exact(inp, 8))
+        if key == BATCH_END_KEY:
+            if stream:
+                out.write(struct.pack(">II", BATCH_END_KEY, 0))
+            else:
+                body = json.dumps(lengths).encode()
+                out.write(struct.pack(">I", len(body)) + body)
+                lengths = []
+            out.flush()
+            continue
+        data = read_exact(inp, length)
+        if stream:
+            body = json.dumps(convert(data)).encode()
+            out.write(struct.pack(">II", key, len(body)) + body)
+            out.flush()
+        else:
+            lengths.append(convert(data))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+import os
+import asyncio
+import tempfile
+import threading
+import time
+
+import dill
+import pytest
+
+from Modules.aws_datasource_container import AwsDataSourceSession
+from Modules.async_datasource_container import run_targets
+from Modules.detector.freq2 import FrequencyDetector, SaveData
+
+BUCKET = "bucket"
+DELAY = 0.02
+
+
+class FilesystemS3Client(object):
+    u"""
+        バケットをディレクトリに見立てた boto3 の S3 クライアントの代わり。
+        同時に実行中の読み込み・アップロードの数の最大値を記録する。
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.uploaded = {}
+        self.max_concurrent = {"load": 0, "upload": 0}
+        self.__running = {"load": 0, "upload": 0}
+        self.__lock = threading.Lock()
+
+    def __path(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    def __enter_op(self, kind):
+        with self.__lock:
+            self.__running[kind] += 1
+            self.max_concurrent[kind] = max(self.max_concurrent[kind], self.__running[kind])
+        time.sleep(DELAY)
+
+    def __exit_op(self, kind):
+        with self.__lock:
+            self.__running[kind] -= 1
+
+    def put(self, key, data):
+        os.makedirs(os.path.dirname(self.__path(key)), exist_ok=True)
+        with open(self.__path(key), "wb") as f:
+            f.write(data)
+
+    def download_fileobj(self, bucket, key, fileobj):
+        self.__enter_op("load")
+        try:
+            with open(self.__path(key), "rb") as f:
+                fileobj.write(f.read())
+        finally:
+            self.__exit_op("load")
+
+    def upload_file(self, local_path, bucket, key, Config=None):
+        self.__enter_op("upload")
+        try:
+            with open(local_path, "rb") as f:
+                data = f.read()
+            self.put(key, data)
+            with self.__lock:
+                self.uploaded[key] = data
+        finally:
+            self.__exit_op("upload")
+
+
+class FilesystemSession(AwsDataSourceSession):
+    def __init__(self, s3_client, **kwargs):
+        super(FilesystemSession, self).__init__(**kwargs)
+        self.fake_s3_client = s3_client
+
+    @property
+    def s3_client(self):
+        return self.fake_s3_client
+
+
+@pytest.fixture
+def session_env(tmp_path, monkeypatch):
+    # セッション開始時に一時ディレクトリが掃除されるので、バケットとは別の場所にする
+    temp_dir = tmp_path / "tmp"
+    temp_dir.mkdir()
+    monkeypatch.setattr(tempfile, "tempdir", str(temp_dir))
+    s3_client = FilesystemS3Client(str(tmp_path / "bucket"))
+    session = FilesystemSession(
+        s3_client,
+        src_bucket_name=BUCKET,
+        base_system_key="sys",
+        base_data_key="data",
+        aws_id="aws",
+        mgmt_id="mgmt",
+        report_id="1",
+        table_name="table",
+        path_temp_score_db_key="pathscore",
+        freq_temp_score_db_key="freqscore")
+    return session, s3_client
+
+
+def test_run_targets_overlaps_loads_and_isolates_scores(session_env):
+    session, s3_client = session_env
+    target_names = [f"target{i}" for i in range(4)]
+    blob = dill.dumps(SaveData(FrequencyDetector()))
+    for target_name in target_names:
+        fsname = session.container(target_name).get_file_sys_name()
+        for hour in range(24):
+            s3_client.put(f"sys/reportModels/7/{fsname}/{hour}", blob)
+
+    async def process(container):
+        detectors = await container.load_freq_model_file("7", container.get_file_sys_name(), 1e-10)
+        # score_db の代わりに、この対象のスコアファイルを出力先に書く
+        output_dir = os.path.join(container.container.aws_score_db.output_dir, "path")
+        os.makedirs(output_dir, exist_ok=True)
+        with open(os.path.join(output_dir, "20200101.csv"), "w") as f:
+            f.write(container.get_target_name())
+        return container.get_file_sys_name(), len(detectors)
+
+    async def main():
+        with session:
+            return await run_targets(session, target_names, process, concurrency=4)
+
+    results = asyncio.run(main())
+
+    assert [count for _, count in results] == [24] * len(target_names)
+    # 対象をまたいで読み込みが並行に行われる
+    assert s3_client.max_concurrent["load"] > 24 // 8
+    # スコアはセッション終了時に並列にアップロードされ、対象ごとに自分のファイルだけが送られる
+    assert s3_client.max_concurrent["upload"] > 1
+    assert s3_client.uploaded == {
+        f"pathscore/20200101/{fsname}.csv": target_name.encode()
+        for (fsname, _), target_name in zip(results, target_names)
+    }
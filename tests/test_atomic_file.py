@@ -0,0 +1,52 @@
+import os
+import pickle
+
+import pytest
+
+import pickle_rewriter
+from Modules.util.atomic_file import atomic_open, atomic_write
+
+
+def test_atomic_write_keeps_existing_mode(tmp_path):
+    path = tmp_path / "model"
+    path.write_bytes(b"old")
+    os.chmod(path, 0o640)
+
+    atomic_write(str(path), b"new")
+
+    assert path.read_bytes() == b"new"
+    assert os.stat(path).st_mode & 0o7777 == 0o640
+    assert os.listdir(tmp_path) == ["model"]
+
+
+def test_atomic_write_new_file_is_not_private(tmp_path):
+    path = tmp_path / "sub" / "model"
+    atomic_write(str(path), b"new")
+
+    umask = os.umask(0)
+    os.umask(umask)
+    assert os.stat(path).st_mode & 0o7777 == 0o666 & ~umask
+
+
+def test_atomic_open_keeps_original_on_failure(tmp_path):
+    path = tmp_path / "model"
+    path.write_bytes(b"old")
+
+    with pytest.raises(RuntimeError):
+        with atomic_open(str(path)) as f:
+            f.write(b"partial")
+            raise RuntimeError()
+
+    assert path.read_bytes() == b"old"
+    assert os.listdir(tmp_path) == ["model"]
+
+
+def test_rewrite_file_keeps_mode(tmp_path):
+    path = tmp_path / "model.pkl"
+    path.write_bytes(pickle.dumps({"a": [1, 2]}, protocol=2))
+    os.chmod(path, 0o644)
+
+    pickle_rewriter.rewrite_file(str(path), 4)
+
+    assert pickle.loads(path.read_bytes()) == {"a": [1, 2]}
+    assert os.stat(path).st_mode & 0o7777 == 0o644
@@ -0,0 +1,39 @@
+import time
+import threading
+
+import dill
+
+import Modules.aws_datasource_container as aws_datasource_container
+from Modules.aws_datasource_container import AwsDataSourceContainer
+from Modules.detector.freq2 import FrequencyDetector, SaveData
+
+
+class DictS3Client(object):
+    def __init__(self, objects):
+        self.objects = objects
+
+    def download_fileobj(self, bucket, key, fileobj):
+        fileobj.write(self.objects[key])
+
+
+def test_freq_models_share_one_lazily_created_client(monkeypatch):
+    container = AwsDataSourceContainer("bucket", "sys", "data", "aws", "mgmt", "1", "table", "Alice")
+    fsname = container.get_file_sys_name()
+    blob = dill.dumps(SaveData(FrequencyDetector()))
+    client = DictS3Client({f"sys/reportModels/7/{fsname}/{hour}": blob for hour in range(24)})
+    created = []
+    created_lock = threading.Lock()
+
+    def create_client(service_name):
+        # 作成に時間がかかる間に別のスレッドが作成を始めると、複数のクライアントができる
+        time.sleep(0.05)
+        with created_lock:
+            created.append(service_name)
+        return client
+
+    monkeypatch.setattr(aws_datasource_container.boto3, "client", create_client)
+
+    detectors = container.load_freq_model_file("7", fsname, 1e-10)
+
+    assert sorted(detectors) == list(range(24))
+    assert created == ["s3"]
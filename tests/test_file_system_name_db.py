@@ -0,0 +1,52 @@
+import pytest
+
+from Modules.file_system_name_db import FileSystemNameDb, Target
+
+
+def committed_names(db_path):
+    # 別の接続から見えるのはコミットされたものだけ
+    with FileSystemNameDb(db_path) as other:
+        return other.export_name_map()
+
+
+def index_names(db):
+    return [row[0] for row in db.conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")]
+
+
+def test_store_many_commits(tmp_path):
+    db_path = str(tmp_path / "fsname.db")
+    with FileSystemNameDb(db_path) as db:
+        db.store_many([Target("Alice", "a"), Target("Bob", "b")])
+
+        assert committed_names(db_path) == {"Alice": "a", "Bob": "b"}
+        assert "fsnameindex" in index_names(db)
+
+
+def test_store_many_keeps_pending_writes_for_caller(tmp_path):
+    db_path = str(tmp_path / "fsname.db")
+    with FileSystemNameDb(db_path) as db:
+        db.store(Target("Alice", "a"))
+        db.store_many([Target("Bob", "b")])
+
+        # 呼び出し側のトランザクションの中で格納したので、コミットは呼び出し側が行う
+        assert committed_names(db_path) == {}
+        db.commit()
+        assert committed_names(db_path) == {"Alice": "a", "Bob": "b"}
+
+
+def test_store_many_rolls_back_only_its_own_writes(tmp_path):
+    db_path = str(tmp_path / "fsname.db")
+
+    def broken_targets():
+        yield Target("Bob", "b")
+        raise ValueError("broken input")
+
+    with FileSystemNameDb(db_path) as db:
+        db.store(Target("Alice", "a"))
+        with pytest.raises(ValueError):
+            db.store_many(broken_targets())
+
+        assert db.export_name_map() == {"Alice": "a"}
+        assert "fsnameindex" in index_names(db)
+        db.commit()
+        assert committed_names(db_path) == {"Alice": "a"}
@@ -0,0 +1,97 @@
+import os
+import types
+
+import numpy as np
+import pytest
+
+from Modules.detector.freq2 import FrequencyDetector, SaveData
+from Modules.file_system_name_db import hash_target_name
+from Modules.local_datasource_container import LocalDataSourceContainer
+
+
+def create_container(root_dir, **kwargs):
+    return LocalDataSourceContainer(str(root_dir), "sys", "data", 1, "Alice", **kwargs)
+
+
+def test_reportmodel_is_stored_under_root_dir(tmp_path):
+    status = types.SimpleNamespace(report_id=1, risk_kind=2, model_id="7")
+    create_container(tmp_path).save_model_data(status)
+
+    # 別のインスタンスからも同じ root_dir のモデル情報が読める
+    container = create_container(tmp_path)
+    assert container.get_reportmodel(1, 2) == status
+    assert container.get_reportmodel(1, 3) is None
+
+
+def test_reportmodel_uses_injected_model_db(tmp_path):
+    class ModelDb(object):
+        def get_cur_report_model(self, report_id, risk_kind):
+            return (report_id, risk_kind)
+
+    assert create_container(tmp_path, model_db=ModelDb()).get_reportmodel(1, 2) == (1, 2)
+
+
+def test_file_sys_name_matches_cloud(tmp_path):
+    container = create_container(tmp_path)
+    assert container.get_file_sys_name() == hash_target_name("alice")
+
+
+def test_set_dataset_reads_training_data_in_place(tmp_path):
+    container = create_container(tmp_path)
+    csv_path = tmp_path / "data" / container.get_file_sys_name() / "20200101.csv"
+    csv_path.parent.mkdir(parents=True)
+    csv_path.write_text("a,b\n")
+
+    # AwsDataSourceContainer と同じ引数で呼べて、学習データを移動もコピーもしない
+    assert container.set_dataset(None, max_workers=4, max_bytes=1) is None
+    assert container.collect_target_fsname_and_csv_file_paths(1) == [
+        (container.get_file_sys_name(), [str(csv_path)])
+    ]
+
+
+def create_detector():
+    detector = FrequencyDetector(inflate_size=200)
+    detector.learn(list(np.random.default_rng(0).integers(0, 50, 100)))
+    return detector
+
+
+@pytest.mark.parametrize("out_of_band_models", [False, True])
+def test_freq_models_round_trip(tmp_path, out_of_band_models):
+    container = create_container(tmp_path, out_of_band_models=out_of_band_models)
+    fsname = container.get_file_sys_name()
+    detectors = {hour: create_detector() for hour in range(24)}
+    for hour, detector in detectors.items():
+        container.save_freq_model_file("7", fsname, hour, detector)
+
+    model_dir = tmp_path / "sys" / "reportModels" / "7" / fsname
+    data = (model_dir / "0").read_bytes()
+    assert SaveData.is_out_of_band(data) == out_of_band_models
+    # 一時ファイルはリネームで置き換わり、残らない
+    assert sorted(os.listdir(model_dir)) == sorted(str(hour) for hour in range(24))
+
+    loaded = create_container(tmp_path).load_freq_model_file("7", fsname, 1e-10)
+    assert sorted(loaded) == list(range(24))
+    for hour, detector in loaded.items():
+        assert np.allclose(detector.detect([1, 5, 30]), detectors[hour].detect([1, 5, 30]))
+
+
+def test_freq_models_missing_hour(tmp_path):
+    container = create_container(tmp_path)
+    fsname = container.get_file_sys_name()
+    for hour in range(23):
+        container.save_freq_model_file("7", fsname, hour, create_detector())
+
+    assert container.load_freq_model_file("7", fsname, 1e-10) is None
+
+
+def test_fpd_file_round_trip(tmp_path):
+    container = create_container(tmp_path)
+    fsname = container.get_file_sys_name()
+    assert container.load_fpd_file("7", fsname) is None
+    assert not container.check_fpd_file("7", fsname)
+
+    container.save_fpd_file({"fpd": [1, 2, 3]}, "7", fsname)
+    container.save_fpd_file({"fpd": [4]}, "7", fsname)
+
+    assert container.check_fpd_file("7", fsname)
+    assert create_container(tmp_path).load_fpd_file("7", fsname) == {"fpd": [4]}
@@ -0,0 +1,121 @@
+import os
+import sys
+import json
+import time
+import stat
+
+import pytest
+
+import multiple_subprocess
+from multiple_subprocess import ConverterPool, ConverterWorker, convert_sharded
+
+FAKE_CONVERTER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_converter.py")
+
+
+def converter_cmd(mode):
+    return [sys.executable, FAKE_CONVERTER, mode]
+
+
+def test_request_returns_json():
+    with ConverterPool(size=1, cmd=converter_cmd("--serve"), timeout=10) as pool:
+        assert json.loads(pool.convert({1: b"ab", 2: b"c" * 100000})) == [{"len": 2}, {"len": 100000}]
+        assert json.loads(pool.convert({3: b"x"})) == [{"len": 1}]
+
+
+def test_request_times_out_when_converter_stops_reading(monkeypatch):
+    monkeypatch.setenv("FAKE_CONVERTER_STALL", "1")
+    worker = ConverterWorker(converter_cmd("--serve"))
+    # パイプのバッファに収まらない大きさにして、書き込みが止まるようにする
+    payload = {1: b"x" * (16 << 20)}
+
+    started = time.monotonic()
+    with pytest.raises(TimeoutError):
+        worker.request(payload, timeout=0.5)
+
+    assert time.monotonic() - started < 5
+    assert not worker.is_alive()
+
+
+def test_stream_waits_for_slow_producer():
+    def slow_items():
+        for key in range(3):
+            # 応答を待っているフレームがない間は、frame_timeout を過ぎても打ち切らない
+            time.sleep(0.6)
+            yield key, b"x" * (key + 1)
+
+    worker = ConverterWorker(converter_cmd("--stream"))
+    try:
+        results = list(worker.stream(slow_items(), frame_timeout=0.3))
+        assert results == [(0, {"len": 1}), (1, {"len": 2}), (2, {"len": 3})]
+        assert worker.is_alive()
+    finally:
+        worker.stop()
+
+
+def test_stream_times_out_while_frame_in_flight(monkeypatch):
+    monkeypatch.setenv("FAKE_CONVERTER_STALL", "1")
+    worker = ConverterWorker(converter_cmd("--stream"))
+
+    with pytest.raises(RuntimeError, match="timed out"):
+        list(worker.stream([(1, b"x")], frame_timeout=0.3))
+
+    assert not worker.is_alive()
+
+
+def test_stream_raises_producer_error():
+    def broken_items():
+        yield 1, b"x"
+        raise ValueError("broken producer")
+
+    worker = ConverterWorker(converter_cmd("--stream"))
+    results = []
+    with pytest.raises(ValueError, match="broken producer"):
+        for item in worker.stream(broken_items(), frame_timeout=5):
+            results.append(item)
+
+    assert results == [(1, {"len": 1})]
+    assert not worker.is_alive()
+
+
+@pytest.fixture
+def one_shot_converter(tmp_path, monkeypatch):
+    # convert_pickles_to_jsonarr はスクリプトを直接起動するので、fake_converter を呼ぶ実行ファイルを置く
+    script = tmp_path / "pickle_json_converter.bin"
+    script.write_text(f"#!/bin/sh\nexec {sys.executable} {FAKE_CONVERTER} \"$@\"\n")
+    script.chmod(script.stat().st_mode | stat.S_IXUSR)
+    monkeypatch.setattr(multiple_subprocess, "get_converter_script", lambda: str(script))
+
+
+def sharded_input():
+    return {key: (b"BAD" if key in (3, 11) else b"ok") + b"x" * key for key in range(20)}
+
+
+def test_convert_sharded_uses_one_shot_converter_by_default(one_shot_converter):
+    scr_data = sharded_input()
+    results, failures = convert_sharded(scr_data, workers=4, timeout=10)
+
+    assert sorted(failures) == [3, 11]
+    assert "bad pickle" in failures[3]
+    assert results == {key: {"len": len(data)} for key, data in scr_data.items() if key not in (3, 11)}
+
+
+def test_convert_sharded_with_pool():
+    scr_data = sharded_input()
+    with ConverterPool(size=3, cmd=converter_cmd("--serve"), timeout=10) as pool:
+        results, failures = convert_sharded(scr_data, pool=pool)
+
+    assert sorted(failures) == [3, 11]
+    assert sorted(results) == sorted(set(scr_data) - {3, 11})
+
+
+def test_convert_sharded_with_convert_func():
+    shards = []
+
+    def convert_func(shard):
+        shards.append(shard)
+        return json.dumps([len(data) for data in shard.values()])
+
+    results, failures = convert_sharded({1: b"a", 2: b"bb", 3: b"ccc"}, workers=2, convert_func=convert_func)
+
+    assert results == {1: 1, 2: 2, 3: 3} and failures == {}
+    assert len(shards) == 2
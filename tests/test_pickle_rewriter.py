@@ -0,0 +1,76 @@
+import pickle
+
+import dill
+import numpy as np
+import pytest
+
+import pickle_converter
+import pickle_rewriter
+from Modules.detector.freq2 import FrequencyDetector, SaveData
+
+
+def create_detector():
+    detector = FrequencyDetector(inflate_size=200)
+    detector.learn(list(np.random.default_rng(0).integers(0, 50, 100)))
+    return detector
+
+
+def assert_same_detector(savedata, detector):
+    loaded = FrequencyDetector()
+    savedata.set_params(loaded)
+    assert np.allclose(loaded.detect([1, 5, 30]), detector.detect([1, 5, 30]))
+
+
+@pytest.mark.parametrize("source_protocol", [4, 5])
+def test_qualified_global_is_not_rewritten_below_protocol_4(source_protocol):
+    data = dill.dumps(SaveData(create_detector()), protocol=source_protocol)
+
+    # gaussian_kde.scotts_factor などの修飾名は、プロトコル 4 未満の GLOBAL では解決できない
+    with pytest.raises(ValueError, match="qualified name"):
+        pickle_rewriter.rewrite_protocol(data, 3)
+
+
+@pytest.mark.parametrize("source_protocol", [4, 5])
+@pytest.mark.parametrize("target_protocol", [2, 3])
+def test_convert_savedata_to_lower_protocol(tmp_path, source_protocol, target_protocol):
+    detector = create_detector()
+    path = tmp_path / "0"
+    path.write_bytes(dill.dumps(SaveData(detector), protocol=source_protocol))
+
+    # 書き換えで変換できないものは dill でロードし直して変換する
+    _, status, _, error = pickle_converter.convert_one(str(path), target_protocol, rewrite=True)
+
+    assert (status, error) == ("converted", None)
+    data = path.read_bytes()
+    assert data[1] == target_protocol
+    assert_same_detector(dill.loads(data), detector)
+
+
+@pytest.mark.parametrize("target_protocol", [2, 3, 4, 5])
+def test_rewrite_plain_objects(target_protocol):
+    obj = {"a": [1, 2.5, "text" * 100], "b": (None, True), "c": {1: [{}]}}
+    for source_protocol in range(2, 6):
+        rewritten = pickle_rewriter.rewrite_protocol(pickle.dumps(obj, protocol=source_protocol), target_protocol)
+        assert pickle.loads(rewritten) == obj
+
+
+def test_verify_protocol_rejects_broken_output():
+    data = pickle.dumps({"a": [1, 2]}, protocol=4)
+    pickle_rewriter.verify_protocol(data, 4)
+
+    for broken in (data[:-3], data + b".", data[:1] + b"\x03" + data[2:]):
+        with pytest.raises(ValueError):
+            pickle_rewriter.verify_protocol(broken, 4)
+
+
+def test_convert_one_falls_back_when_rewrite_is_broken(tmp_path, monkeypatch):
+    path = tmp_path / "model.pkl"
+    path.write_bytes(pickle.dumps({"a": [1, 2]}, protocol=2))
+    # 書き換えが壊れたバイト列を返しても、検証で弾いて dill での変換に切り替える
+    monkeypatch.setattr(
+        pickle_rewriter, "rewrite_protocol", lambda data, target_protocol: b"\x80\x04broken")
+
+    _, status, _, error = pickle_converter.convert_one(str(path), 4, rewrite=True)
+
+    assert (status, error) == ("converted", None)
+    assert pickle.loads(path.read_bytes()) == {"a": [1, 2]}